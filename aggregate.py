@@ -0,0 +1,205 @@
+"""
+This module handles the running contributor totals of Github Organizations.
+"""
+from bisect import bisect_left, insort
+from cache import SqliteStore, SYNC_INTERVAL
+from cachetools import LRUCache
+from datetime import datetime
+from records import Contributor
+from threading import RLock
+from time import monotonic
+from typing import Dict, List, Optional, Set, Tuple
+
+aggregate_store = SqliteStore("data/aggregate.cache")
+aggregatecache = LRUCache(maxsize=1000)
+aggregatecache_lock = RLock()
+INDEX_REBUILD_SHARE = 0.25
+
+
+class OrgAggregate:
+    """The contributor totals of an organization, built one repository at a time.
+
+    Repositories are added as they finish loading, so a ranking (possibly a
+    partial one) is available at any point. The aggregate keeps each
+    repository's share of the totals, so refreshing a repository subtracts its
+    old counts and adds the new ones, and the ranking index is adjusted in
+    place for just the contributors whose totals changed. A change touching
+    more than `INDEX_REBUILD_SHARE` of the index, like the first repositories
+    of a new aggregate, sorts the index again once instead.
+
+    Each share is stored as its own row of `aggregate_store`, and `store`
+    writes just the shares that changed. The totals are summed from the shares
+    when an aggregate is read, and other processes' stored shares are applied
+    to the aggregates in memory as deltas, see `sync`.
+    """
+    next_sync = 0.0
+
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = RLock()
+        self.shares: Dict[str, Tuple[datetime, Dict[str, int]]] = {}
+        self.totals: Dict[str, Contributor] = {}
+        self.index: List[Tuple[int, str]] = []
+        self.dirty: Set[str] = set()
+
+    def sorted_index(self) -> List[Tuple[int, str]]:
+        return sorted((-contrib.contributions, username) for username, contrib in self.totals.items())
+
+    @classmethod
+    def load(cls, name: str, fresh=False, create=True) -> Optional["OrgAggregate"]:
+        """Returns the stored aggregate of org `name`, or a new one if `create`.
+
+        With `fresh`, the stored aggregate is discarded.
+        """
+        with aggregatecache_lock:
+            cls.sync()
+            if fresh:
+                for key in aggregate_store.keys(f"{name}/"):
+                    aggregate_store.delete(key)
+                aggregate = None
+            else:
+                aggregate = aggregatecache.get(name)
+                if aggregate is None:
+                    aggregate = cls.read(name)
+            if aggregate is None and create:
+                aggregate = cls(name)
+            if aggregate is not None:
+                aggregatecache[name] = aggregate
+            return aggregate
+
+    @classmethod
+    def read(cls, name: str) -> Optional["OrgAggregate"]:
+        """Sums the stored shares of org `name`, None if it has none."""
+        aggregate = cls(name)
+        for key, (last_push, share, images) in aggregate_store.items(f"{name}/"):
+            aggregate.shares[key[len(name) + 1:]] = (last_push, share)
+            for username, contributions in share.items():
+                if username not in aggregate.totals:
+                    aggregate.totals[username] = Contributor(username, None, images.get(username), 0)
+                aggregate.totals[username].contributions += contributions
+        if not aggregate.shares:
+            return None
+        aggregate.index = aggregate.sorted_index()
+        return aggregate
+
+    @classmethod
+    def sync(cls):
+        """Applies the shares other processes stored or removed to the aggregates in memory.
+
+        Checks at most once every `SYNC_INTERVAL` seconds. Call with
+        `aggregatecache_lock` held.
+        """
+        if monotonic() < cls.next_sync:
+            return
+        cls.next_sync = monotonic() + SYNC_INTERVAL
+        changed = aggregate_store.changes()
+        if changed is None:
+            aggregatecache.clear()
+            return
+        for key in changed:
+            name, url = key.split("/", 1)
+            aggregate = aggregatecache.get(name)
+            if aggregate is None:
+                continue
+            try:
+                row = aggregate_store.get(key)
+            except KeyError:
+                row = None
+            with aggregate.lock:
+                aggregate.replace(url, row)
+
+    def store(self):
+        """Writes the shares that changed since the last `store`."""
+        with self.lock:
+            for url in self.dirty:
+                key = f"{self.name}/{url}"
+                if url in self.shares:
+                    last_push, share = self.shares[url]
+                    images = {username: self.totals[username].image for username in share if username in self.totals}
+                    aggregate_store.put(key, (last_push, share, images))
+                else:
+                    aggregate_store.delete(key)
+            self.dirty.clear()
+
+    def includes(self, repo) -> bool:
+        """Whether the current push of `repo` is part of the totals."""
+        with self.lock:
+            share = self.shares.get(repo.url)
+            return share is not None and share[0] == repo.last_push
+
+    def retain(self, repositories):
+        """Subtracts the shares of repositories the org no longer has."""
+        current = set(repo.url for repo in repositories)
+        with self.lock:
+            for url in [url for url in self.shares if url not in current]:
+                self.remove(url)
+
+    def adjust(self, username, delta):
+        """Moves `username`'s total by `delta`, keeping the index sorted."""
+        contrib = self.totals[username]
+        del self.index[bisect_left(self.index, (-contrib.contributions, username))]
+        contrib.contributions += delta
+        if contrib.contributions > 0:
+            insort(self.index, (-contrib.contributions, username))
+        else:
+            del self.totals[username]
+
+    def apply(self, deltas: Dict[str, int], images: Dict[str, Optional[str]] = None):
+        """Moves the totals by `deltas`, taking the avatars of contributors new to the totals from `images`."""
+        deltas = {username: delta for username, delta in deltas.items() if delta != 0}
+        rebuild = len(deltas) > len(self.index) * INDEX_REBUILD_SHARE
+        for username, delta in deltas.items():
+            if username not in self.totals:
+                self.totals[username] = Contributor(username, None, images[username], 0)
+                if not rebuild:
+                    insort(self.index, (0, username))
+            if not rebuild:
+                self.adjust(username, delta)
+            elif self.totals[username].contributions + delta > 0:
+                self.totals[username].contributions += delta
+            else:
+                del self.totals[username]
+        if rebuild:
+            self.index = self.sorted_index()
+
+    def replace(self, url: str, row: Optional[Tuple[datetime, Dict[str, int], Dict[str, Optional[str]]]]):
+        """Swaps the share of `url` for `row`, as stored, or removes it if `row` is None."""
+        old = self.shares.pop(url, (None, {}))[1]
+        share, images = {}, {}
+        if row is not None:
+            last_push, share, images = row
+            self.shares[url] = (last_push, share)
+        self.apply({username: share.get(username, 0) - old.get(username, 0)
+                    for username in set(old).union(share)}, images)
+
+    def remove(self, url):
+        with self.lock:
+            self.replace(url, None)
+            self.dirty.add(url)
+
+    def add(self, repo):
+        """Replaces the repository's share of the totals with its loaded contributors.
+
+        Does nothing if its current push is already included.
+        """
+        with self.lock:
+            if self.includes(repo):
+                return
+            share = {username: contrib.contributions for username, contrib in repo.contributors.items()}
+            images = {username: contrib.image for username, contrib in repo.contributors.items()}
+            self.replace(repo.url, (repo.last_push, share, images))
+            self.dirty.add(repo.url)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key: slice) -> List[Contributor]:
+        """The contributors at the `key` slice of the ranking by total contributions."""
+        with self.lock:
+            return [self.totals[username] for _, username in self.index[key]]
+
+    def completeness(self, repositories) -> float:
+        """The share of `repositories` whose current push is part of the totals."""
+        if len(repositories) == 0:
+            return 1.0
+        return sum(1 for repo in repositories if self.includes(repo)) / len(repositories)
@@ -1,12 +1,21 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from math import ceil
 from os import getenv
+from queue import Queue
+from threading import Lock
 from dotenv import load_dotenv
-from typing import Optional, Tuple, Union
-from github import GithubAPIException
+from typing import Callable, Hashable, Iterator, Optional, Set, Tuple, Union
+from github import budget, budget_exhausted, GithubAPIException, Priority, priority, RequestBudget, RequestBudgetExhausted
 from utils import format_top_contributer
-from flask import Flask,request, jsonify, render_template
-from organization import Organization, OrganizationTooLargeException
-from cache import CacheControl, ResponseCache
+from flask import Flask,request, jsonify, json, render_template, Response, stream_with_context
+from organization import Organization, SYNC_REPO_LIMIT
+from refresher import refresh_scheduler
+from cache import CacheControl
+from responses import EncodedBody
+from snapshot import RankingSnapshot, decode_cursor
+from webhooks import handle_event, verify_signature, WebhookPayloadException
 from github import api
 from flask_cors import CORS
 
@@ -15,65 +24,229 @@ app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 DEBUG = False
 load_dotenv()
-api.set_auth_token(getenv("GITHUB_TOKEN"))
+api.set_auth_tokens(getenv("GITHUB_TOKENS", getenv("GITHUB_TOKEN", "")).split(","))
+REQUEST_CALL_BUDGET = int(getenv("REQUEST_CALL_BUDGET", 0))
+REQUEST_TIME_BUDGET = float(getenv("REQUEST_TIME_BUDGET", 0))
+stream_pool = ThreadPoolExecutor(max_workers=int(getenv("STREAM_THREADS", 16)), thread_name_prefix="stream")
+continue_pool = ThreadPoolExecutor(max_workers=int(getenv("CONTINUE_THREADS", 4)), thread_name_prefix="continue")
+continuing: Set[Hashable] = set()
+continuing_lock = Lock()
 if DEBUG:
     import urllib3
     urllib3.disable_warnings()
     api.proxies = {'https': 'http://localhost:8080', 'http': 'localhost:8080'}
     api.verify = False
-maincache = ResponseCache()
+refresh_scheduler.start()
 
 @app.route("/", methods=["GET"])
 def root():
     return render_template('index.html')
 
+def request_limits() -> Optional[RequestBudget]:
+    """The request's budget: the server's, lowered by the `max_calls` and `max_seconds` query params."""
+    def lowest(configured, asked):
+        limits = [limit for limit in (configured, asked) if limit is not None and limit > 0]
+        return min(limits) if limits else None
+    calls = lowest(REQUEST_CALL_BUDGET, request.args.get('max_calls', type=int))
+    seconds = lowest(REQUEST_TIME_BUDGET, request.args.get('max_seconds', type=float))
+    if calls is None and seconds is None:
+        return None
+    return RequestBudget(calls, seconds)
+
+def int_arg(name: str, default: int) -> Optional[int]:
+    """The query param `name` as an int, `default` if it's missing, or None if it isn't a whole number."""
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
 @app.route('/<orgname>') #type: ignore
 def organization(orgname: str) -> Union[Optional[str] , Tuple[Optional[str], int]]:
+    limits = request_limits()
+    with budget(limits):
+        return organization_page(orgname, limits)
+
+def organization_page(orgname: str, limits: Optional[RequestBudget]):
     cachetype = CacheControl.parse_cachecontrol(request)
     force_refresh = cachetype == CacheControl.NoCache
-    try:
-        org = Organization(orgname, force_refresh)
-    except OrganizationTooLargeException as e:
-        return jsonify({"message": e.message}),501
-
+    per_page = int_arg('per_page', 20)
+    page = int_arg('page', 1)
+    if per_page is None or page is None or page < 1:
+        return jsonify({"message": "per_page and page must be whole numbers, page at least 1"}), 400
+    per_page = max(1, min(per_page, 100))
+    stream = request.args.get('stream') == 'ndjson'
+    token = request.args.get('snapshot')
+    offset = (page - 1) * per_page
+    if cursor := decode_cursor(request.args.get('cursor', '')):
+        token, offset = cursor
 
+    org = None
+    snapshot = None
     if cachetype == CacheControl.CacheOK:
-        if pair := maincache.get_withargs(orgname, request.args):
-            if pair[0] is not None and pair[1] is not None:
-                resp = pair[0]
-                date_changed = pair[1]
-                headers = {'Last-Modified': CacheControl.get_modifiedsince(date_changed)}
-                return jsonify(resp), 200, headers #type: ignore
-    if cachetype == CacheControl.IfUnchangedSince:
-        since = cachetype.parse_modifiedsince(request)
-        if since and not org.changed_since(since):
-            return ('', 304, {
-                'Last-Modified': CacheControl.get_modifiedsince(org.last_changed)
-            })  #type: ignore
-
-    per_page = min(int(request.args.get('per_page', '20')), 100)
-    page = int(request.args.get('page', '1'))
-    top, pages = org.get_top_contributors(per_page, page)
-    count_contrib = len(org.contributors)
-    org.daemon_loader()
-    top_formatted = list(map(format_top_contributer, top))
+        snapshot = RankingSnapshot.load(orgname, token)
+    if snapshot is None:
+        org = Organization(orgname, force_refresh,
+                           revalidate=cachetype == CacheControl.Revalidate)
+        if cachetype == CacheControl.IfUnchangedSince:
+            since = cachetype.parse_modifiedsince(request)
+            if since and not org.changed_since(since):
+                return ('', 304, {
+                    'Last-Modified': CacheControl.get_modifiedsince(org.last_changed)
+                })  #type: ignore
+        org.load_contributors(SYNC_REPO_LIMIT)
+        if org.completeness == 1:
+            snapshot = RankingSnapshot.take(org, fresh=force_refresh)
+
+    resolve = None
+    if snapshot is not None:
+        if not stream and (body := EncodedBody.load(snapshot.page_key(offset, per_page))):
+            refresh_scheduler.record_request(orgname, org)
+            return body.response(request, snapshot.last_changed)
+        top = snapshot.page(offset, per_page)
+        if snapshot.unresolved(offset, per_page):
+            top = [contrib.copy() for contrib in top]
+            def resolve(on_resolved=None):
+                done = set()
+                def resolved(contrib):
+                    done.add(contrib.username)
+                    if on_resolved is not None:
+                        on_resolved(contrib)
+                page_org = org or Organization(orgname)
+                page_org.load_contributors(SYNC_REPO_LIMIT)
+                page_org.load_last_commits(top, resolved)
+                snapshot.fill(offset, top, done)
+                snapshot.store()
+        count_contrib = len(snapshot)
+        completeness = 1.0
+        last_changed = snapshot.last_changed
+    else:
+        top, _ = org.ranking_page(per_page, page)
+        resolve = lambda on_resolved=None: org.load_last_commits(top, on_resolved)
+        count_contrib = len(org.contributors)
+        completeness = org.completeness
+        last_changed = org.last_changed
+    page_key = (orgname, snapshot.token if snapshot else None, offset, per_page)
+    navigation = {
+        "page": offset // per_page + 1,
+        "per_page": per_page,
+        "total_contributors": count_contrib,
+        "total_pages": ceil(count_contrib / per_page),
+        "completeness": round(completeness, 4),
+        "snapshot": snapshot.token if snapshot else None,
+        "next": snapshot.cursor(offset + per_page) if snapshot else None,
+        "pending": completeness < 1 and budget_exhausted()
+    }
+    headers = {'Last-Modified': CacheControl.get_modifiedsince(last_changed)}
+    if stream:
+        refresh_scheduler.record_request(orgname, org)
+        return Response(stream_with_context(stream_page(navigation, top, resolve, limits, page_key)),
+                        mimetype="application/x-ndjson", headers=headers)
+
+    done = set()
+    if resolve is not None:
+        try:
+            resolve(lambda contrib: done.add(contrib.username))
+        except RequestBudgetExhausted:
+            pass
+    pending = set()
+    if resolve is not None and budget_exhausted():
+        pending = set(contrib.username for contrib in top).difference(done)
+    if snapshot is not None:
+        top = snapshot.page(offset, per_page)
+    refresh_scheduler.record_request(orgname, org)
+    navigation["pending"] = navigation["pending"] or len(pending) > 0
     data = {
-        "navigation": {
-            "page": page,
-            "per_page": per_page,
-            "total_contributors": count_contrib,
-            "total_pages": pages
-        },
-        'data': top_formatted
+        "navigation": navigation,
+        'data': [format_top_contributer(contrib, contrib.username in pending) for contrib in top]
     }
-    maincache.store_withargs((data, org.last_changed), org, request.args)
-    return jsonify(data), {
-        'Last-Modified': CacheControl.get_modifiedsince(org.last_changed)
-    } #type: ignore
+    if pending:
+        continue_resolving(page_key, resolve)
+        return jsonify(data), headers #type: ignore
+    if snapshot is not None:
+        body = EncodedBody.from_response(jsonify(data))
+        body.store(snapshot.page_key(offset, per_page))
+        return body.response(request, last_changed)
+    return jsonify(data), headers #type: ignore
+
+def stream_page(navigation: dict, top: list, resolve: Optional[Callable],
+                limits: Optional[RequestBudget] = None, key: Hashable = None) -> Iterator[str]:
+    """Yields the page as NDJSON: the ranked page first, then each contributor once their last commit resolves.
+
+    The last commits are resolved on `stream_pool`, so the first line goes out
+    before any of them are looked up. If `limits` runs out first, the last
+    line lists the logins still pending, which keep resolving in the
+    background as page `key`.
+    """
+    yield json.dumps({"navigation": navigation, "data": list(map(format_top_contributer, top))}) + "\n"
+    if resolve is None:
+        return
+    resolved = Queue()
+    def run():
+        try:
+            with budget(limits):
+                resolve(resolved.put)
+        except RequestBudgetExhausted:
+            pass
+        except GithubAPIException as e:
+            resolved.put(e)
+        finally:
+            resolved.put(None)
+    stream_pool.submit(copy_context().run, run)
+    done = set()
+    while (contrib := resolved.get()) is not None:
+        if isinstance(contrib, GithubAPIException):
+            yield json.dumps({"error": contrib.response()}) + "\n"
+        else:
+            done.add(contrib.username)
+            yield json.dumps(format_top_contributer(contrib)) + "\n"
+    pending = [contrib.username for contrib in top if contrib.username not in done]
+    if limits is not None and limits.exhausted and pending:
+        yield json.dumps({"pending": pending}) + "\n"
+        continue_resolving(key, resolve)
+
+def continue_resolving(key: Hashable, resolve: Callable):
+    """Resolves the rest of page `key`, whose request budget ran out, on `continue_pool`.
+
+    Requests for a page that is already being resolved don't add another run.
+    """
+    def run():
+        try:
+            with budget(None), priority(Priority.BACKGROUND):
+                resolve()
+        except GithubAPIException as e:
+            print(f"Resolving the rest of a page failed: {e}")
+        finally:
+            with continuing_lock:
+                continuing.discard(key)
+    with continuing_lock:
+        if key in continuing:
+            return
+        continuing.add(key)
+    continue_pool.submit(copy_context().run, run)
+
+@app.route('/webhooks/github', methods=['POST'])
+def github_webhook():
+    """Applies a Github webhook delivery signed with `GITHUB_WEBHOOK_SECRET`."""
+    secret = getenv("GITHUB_WEBHOOK_SECRET")
+    if not secret:
+        return jsonify({"message": "Webhooks are not enabled"}), 404
+    if not verify_signature(request.get_data(), request.headers.get('X-Hub-Signature-256'), secret):
+        return jsonify({"message": "Invalid signature"}), 403
+    payload = request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"message": "Invalid payload"}), 400
+    return jsonify({"result": handle_event(request.headers.get('X-GitHub-Event', ''), payload)})
 
 @app.errorhandler(GithubAPIException)
 def api_error(error):
     return jsonify(error.response()), error.status_code
 
+@app.errorhandler(WebhookPayloadException)
+def payload_error(error):
+    return jsonify({"message": error.message}), 400
+
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
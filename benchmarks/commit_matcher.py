@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of the commit matcher used by `Repository.scan_last_commits`.
+
+Compares `match_commits` against the previous per-commit loop, which
+intersected the needed set and parsed the date of every matching commit.
+
+    python benchmarks/commit_matcher.py [commits] [contributors] [needed]
+"""
+import random
+import sys
+from datetime import datetime
+from pathlib import Path
+from timeit import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from repository import match_commits, parse_commit
+
+
+def make_commits(count, contributors, seed=0):
+    rnd = random.Random(seed)
+    logins = [f"user{n}" for n in range(contributors)]
+    weights = [1 / (n + 1) for n in range(contributors)]
+    commits = []
+    for n in range(count):
+        login = rnd.choices(logins, weights)[0]
+        person = {'email': f"{login}@example.com", 'date': "2020-11-30T12:00:00Z"}
+        commits.append({
+            'sha': f"{n:040x}",
+            'author': {'login': login} if rnd.random() > 0.05 else None,
+            'committer': {'login': login},
+            'commit': {'author': person, 'committer': person, 'message': f"commit {n}"}
+        })
+    return [commits[start:start + 100] for start in range(0, count, 100)], logins
+
+
+def legacy(pages, need_update, only):
+    """The per-commit loop `Repository.load_last_commits` used before the matcher."""
+    found = {}
+    for page in pages:
+        for commit in page:
+            needed = need_update.intersection(only)
+            if ((commit['author'] and commit['author']['login'] in need_update) or (
+                    commit['committer'] and commit['committer']['login'] in need_update)):
+                cmauthor = "author" if (commit['author'] and
+                                        commit['author']['login'] in need_update) else "committer"
+                author = commit[cmauthor]['login']
+                commitdate = datetime.strptime(commit['commit'][cmauthor]['date'], "%Y-%m-%dT%H:%M:%S%z")
+                found[author] = (commit['commit']['message'], commitdate)
+                need_update.remove(author)
+                if len(needed) == 0:
+                    return found
+    return found
+
+
+def batched(pages, need_update, only):
+    found = {}
+    needed = set(only)
+    for page in pages:
+        for author, (commit, cmauthor) in match_commits(page, need_update).items():
+            found[author] = parse_commit(commit, cmauthor)
+            needed.discard(author)
+        if len(needed) == 0:
+            break
+    return found
+
+
+def main(count=50000, contributors=2000, needed=100):
+    pages, logins = make_commits(count, contributors)
+    only = set(logins[-needed:])
+    runs = 5
+    for name, fn in (("legacy", legacy), ("batched", batched)):
+        seconds = timeit(lambda: fn(pages, set(logins), only), number=runs) / runs
+        print(f"{name:8} {seconds * 1000:8.1f} ms per scan of {count} commits "
+              f"({contributors} contributors, {needed} needed)")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,13 +1,23 @@
 """This module handles caching."""
+import atexit
+import fcntl
+import os
 import pickle
+import sqlite3
 import pytz
+import uuid
 from cachetools.cache import Cache
 import flask
-from typing import Dict, Optional, Tuple
-from cachetools import LRUCache, TTLCache
+from typing import Dict, Optional, Set, Tuple
+from cachetools import LRUCache
 from datetime import datetime, timezone
 from pathlib import Path
 from enum import Enum
+from threading import Condition, RLock, Thread
+from time import monotonic
+
+SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", 1.0))
+CHANGE_LOG_SIZE = 100000
 
 class CacheControl(Enum):
     NoCache = 1
@@ -54,7 +64,243 @@ class CacheControl(Enum):
 
 
 
+class SqliteStore:
+    """An incremental on-disk key-value store backed by SQLite.
+
+    Values are pickled when they are written and queued. A background thread
+    flushes the queue in batches, each batch in a single transaction, so a crash
+    leaves either the old or the new value of a key on disk, never a torn file.
+
+    Several processes (e.g. gunicorn workers) can share one store. Every flush
+    also logs the keys it changed, so a process can tell which of its copies
+    another process has since replaced, see `changes`.
+    """
+    header = b"SQLite format 3\x00"
+    deleted = object()
+
+    def __init__(self, path, flush_interval=1.0, batch_size=500, seed=None):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = RLock()
+        self.pending: Dict[str, object] = {}
+        self.wakeup = Condition(self.lock)
+        self.flusher: Optional[Thread] = None
+        self.writer = uuid.uuid4().hex
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.migrate_legacy(seed)
+        self.conn = self.connect(self.path)
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        atexit.register(self.flush)
+
+    @staticmethod
+    def connect(path):
+        conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY, key TEXT NOT NULL, writer TEXT NOT NULL)")
+        return conn
+
+    def migrate_legacy(self, seed=None):
+        """Converts a cache file written by the old whole-file pickle format.
+
+        If there's no cache file yet, the file `seed` in that format is
+        converted in its place. Processes opening the store at the same time
+        take turns on a file lock, so only the first one converts it.
+        """
+        with self.path.with_name(self.path.name + ".lock").open('a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            source = self.path if self.path.is_file() else seed and Path(seed)
+            if source is None or not source.is_file():
+                return
+            with source.open('rb') as f:
+                if f.read(len(self.header)) in (self.header, b""):
+                    return
+                f.seek(0)
+                try:
+                    legacy = pickle.load(f).get('_Cache__data', {})
+                except Exception as e:
+                    print(f"Discarding unreadable cache {source}: {e}")
+                    legacy = {}
+            tmp = self.path.with_name(f"{self.path.name}.{uuid.uuid4().hex}.migrate")
+            try:
+                conn = self.connect(tmp)
+                conn.execute("BEGIN")
+                conn.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?)",
+                                 ((key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in legacy.items()))
+                conn.execute("COMMIT")
+                conn.execute("PRAGMA journal_mode=DELETE")
+                conn.close()
+                os.replace(tmp, self.path)
+            finally:
+                tmp.unlink(missing_ok=True)
+
+    @staticmethod
+    def bounds(prefix: str) -> Tuple[Optional[str], Optional[str]]:
+        """The key range holding the keys that start with `prefix`."""
+        if not prefix:
+            return None, None
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    @staticmethod
+    def between(query: str, start: Optional[str], stop: Optional[str]):
+        """`query` limited to the keys from `start` up to, but not including, `stop`, and its params."""
+        if start is None:
+            return query, ()
+        return query + " WHERE key >= ? AND key < ?", (start, stop)
+
+    def keys(self, prefix=""):
+        start, stop = self.bounds(prefix)
+        with self.lock:
+            keys = set(key for key, in self.conn.execute(*self.between("SELECT key FROM kv", start, stop)))
+            for key, value in self.pending.items():
+                if not key.startswith(prefix):
+                    continue
+                if value is SqliteStore.deleted:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+        return keys
+
+    def items(self, prefix=""):
+        """Yields the keys starting with `prefix` and their values, queued writes included."""
+        return self.range(*self.bounds(prefix))
+
+    def range(self, start: Optional[str], stop: Optional[str]):
+        """Yields the keys from `start` up to, but not including, `stop` and their values, queued writes included.
+
+        With no `start`, yields every key.
+        """
+        with self.lock:
+            rows = dict(self.conn.execute(*self.between("SELECT key, value FROM kv", start, stop)).fetchall())
+            for key, value in self.pending.items():
+                if start is not None and not start <= key < stop:
+                    continue
+                if value is SqliteStore.deleted:
+                    rows.pop(key, None)
+                else:
+                    rows[key] = value
+        for key, value in rows.items():
+            yield key, pickle.loads(value)
+
+    def has(self, key) -> bool:
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key] is not SqliteStore.deleted
+            return self.conn.execute("SELECT 1 FROM kv WHERE key = ?", (key,)).fetchone() is not None
+
+    def changes(self) -> Optional[Set[str]]:
+        """Returns the keys other processes wrote or deleted since the last call.
+
+        `PRAGMA data_version` tells whether anyone else committed at all, so this
+        costs no table reads while nothing changed.
+
+        Returns:
+            The changed keys, or None if the change log was trimmed past the last
+            call, in which case any key may have changed.
+        """
+        with self.lock:
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self.data_version:
+                return set()
+            self.data_version = version
+            self.conn.execute("BEGIN")
+            try:
+                oldest, newest = self.conn.execute("SELECT MIN(seq), MAX(seq) FROM changes").fetchone()
+                rows = self.conn.execute("SELECT key FROM changes WHERE seq > ? AND writer != ?",
+                                         (self.seq, self.writer)).fetchall()
+            finally:
+                self.conn.execute("COMMIT")
+            if newest is None:
+                return set()
+            trimmed = oldest > self.seq + 1
+            self.seq = newest
+        return None if trimmed else set(key for key, in rows)
+
+    def get(self, key):
+        """Returns the stored value of `key`.
+
+        Raises:
+            KeyError: `key` is not stored.
+        """
+        with self.lock:
+            value = self.pending.get(key)
+            if value is None:
+                row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+                value = row[0] if row else SqliteStore.deleted
+        if value is SqliteStore.deleted:
+            raise KeyError(key)
+        return pickle.loads(value)
+
+    def put(self, key, value):
+        self.queue(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def delete(self, key):
+        self.queue(key, SqliteStore.deleted)
+
+    def queue(self, key, value):
+        with self.lock:
+            self.pending[key] = value
+            if self.flusher is None:
+                self.flusher = Thread(target=self.flush_loop, daemon=True)
+                self.flusher.start()
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.notify()
+
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                self.wakeup.wait(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Writes all queued changes in one transaction."""
+        with self.lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?)",
+                                      ((k, v) for k, v in batch.items() if v is not SqliteStore.deleted))
+                self.conn.executemany("DELETE FROM kv WHERE key = ?",
+                                      ((k,) for k, v in batch.items() if v is SqliteStore.deleted))
+                self.conn.executemany("INSERT INTO changes (key, writer) VALUES (?, ?)",
+                                      ((k, self.writer) for k in batch))
+                self.conn.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?",
+                                  (CHANGE_LOG_SIZE,))
+                self.conn.execute("COMMIT")
+                if self.conn.execute("PRAGMA data_version").fetchone()[0] == self.data_version:
+                    # Nobody else committed since our last look, so the log holds nothing new for us.
+                    self.seq = self.conn.execute("SELECT MAX(seq) FROM changes").fetchone()[0]
+            except sqlite3.Error as e:
+                print(f"Flushing {self.path} failed: {e}")
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                batch.update(self.pending)
+                self.pending = batch
+
+
 class StoredLRUCache(LRUCache):
+    """An LRU cache persisted per key to a `SqliteStore` at `path`.
+
+    Every write is queued for the store, so updating one entry never rewrites
+    the whole file. If `keep_evicted` is true, entries that fall out of memory
+    stay on disk and are read back the next time they are accessed.
+
+    If there's no store at `path` yet, it starts out with the entries of the
+    file `seed`, written in the old whole-file pickle format.
+
+    If `lazy` is true only the index of stored keys is read when the cache is
+    opened, and each entry is unpickled on its first access.
+
+    Processes sharing the store see each other's writes: at most every
+    `SYNC_INTERVAL` seconds an access drops the entries another process has
+    changed since, so they are read back from the store.
+    """
 
     @property
     def savepath(self) -> Optional[str]:
@@ -62,67 +308,102 @@ class StoredLRUCache(LRUCache):
 
     @savepath.setter
     def savepath(self, path):
+        self._path = path
         if path is None:
             return
-        self._path = path
-        pathl = Path(self._path)
-        if pathl.is_file():
-            try:
-                p = pathl.open('rb')
-                self.__dict__ = pickle.load(p)
-            except:
-                pass
+        self.store = SqliteStore(path, seed=self.seed)
+        self.stored_keys = self.store.keys()
+        if not self.lazy:
+            for key, value in self.store.items():
+                self.remember(key, value)
 
-    def __init__(self, path=None, *args, **kargs):
+    def __init__(self, path=None, *args, keep_evicted=True, lazy=False, seed=None, **kargs):
         super().__init__(*args, **kargs)
+        self.seed = seed
+        self.store: Optional[SqliteStore] = None
+        self.stored_keys = set()
+        self.keep_evicted = keep_evicted
+        self.lazy = lazy
+        self.evicting = False
+        self.next_refresh = 0.0
         self.savepath = path
 
-    def save(self):
-        if self.savepath is None:
+    def refresh(self):
+        """Forgets the in-memory entries other processes have changed in the store."""
+        if self.store is None or monotonic() < self.next_refresh:
             return
-        try:
-            path = Path(self.savepath)
-            path.touch()
-            p = path.open("wb")
-            pickle.dump(self.__dict__, p)
-        except Exception as e:
-            print(e)
-
+        self.next_refresh = monotonic() + SYNC_INTERVAL
+        changed = self.store.changes()
+        if changed is None:
+            changed = set(self.keys())
+            self.stored_keys = self.store.keys()
+        else:
+            for key in changed:
+                if self.store.has(key):
+                    self.stored_keys.add(key)
+                else:
+                    self.stored_keys.discard(key)
+        for key in changed:
+            if super().__contains__(key):
+                super().__delitem__(key)
 
-class ResponseCache(TTLCache):
+    def remember(self, key, value):
+        """Puts `value` in memory without writing it to the store."""
+        try:
+            super().__setitem__(key, value)
+        except ValueError:
+            pass
 
-    def __init__(self, maxsize=1000000, ttl=(60*60)):
-        super().__init__(maxsize=maxsize, ttl=ttl)
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self.store is not None:
+            self.store.put(key, value)
+            self.stored_keys.add(key)
 
-    def key_fromargs(self, org, args):
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
         try:
-            if type(org) is str:
-                key = org
-            else:
-                key = org.name
-            per_page = args.get('per_page', '20')
-            page = args.get('page', '1')
-            key += f"&per_page={per_page}"
-            key += f"&page={page}"
-            return key
-        except:
-            return None
+            super().__delitem__(key)
+        except KeyError:
+            pass
+        if self.store is not None and not (self.evicting and self.keep_evicted):
+            self.store.delete(key)
+            self.stored_keys.discard(key)
 
-    def store_withargs(self, value, org, args):
-        key = self.key_fromargs(org, args)
-        if key is not None:
-            self[key] = value
+    def __contains__(self, key):
+        self.refresh()
+        return super().__contains__(key) or key in self.stored_keys
 
-    def get_withargs(self, org, args) -> Tuple[Optional[dict], Optional[datetime]]:
-        key = self.key_fromargs(org, args)
-        if key is not None:
-            try:
-                return self[key]
-            except KeyError:
-                return (None, None)
-        else:
-            return (None, None)
+    def __getitem__(self, key):
+        self.refresh()
+        return super().__getitem__(key)
 
+    def __missing__(self, key):
+        if key not in self.stored_keys:
+            raise KeyError(key)
+        try:
+            value = self.store.get(key)
+        except KeyError:
+            self.stored_keys.discard(key)
+            raise
+        self.remember(key, value)
+        return value
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
+    def popitem(self):
+        self.evicting = True
+        try:
+            return super().popitem()
+        finally:
+            self.evicting = False
 
+    def save(self):
+        """Flushes queued writes to disk right away."""
+        if self.store is not None:
+            self.store.flush()
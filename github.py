@@ -1,10 +1,18 @@
 """This module handles requests to the Github API"""
+from contextlib import contextmanager
+from contextvars import ContextVar
 from datetime import datetime
+from enum import IntEnum
 from math import ceil
-from threading import RLock
-from requests import Session
+from os import getenv
+from threading import Condition, Lock, RLock
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+from requests import Request, Response, Session
+from requests.adapters import HTTPAdapter
 from json import dumps
 from humanize import precisedelta
+from cache import StoredLRUCache
 
 class GithubAPIException(Exception):
     def __init__(self, status_code, message):
@@ -28,40 +36,291 @@ class GithubRateLimitExceeded(GithubAPIException):
         self.reset_utc = reset.isoformat()
         self.reset_nice = f"RateLimit resets in {precisedelta(timetilactive, minimum_unit='seconds')}"
 
+class RequestBudgetExhausted(GithubAPIException):
+    """Raised instead of sending a request once the context's `RequestBudget` is spent."""
+    def __init__(self):
+        super().__init__(503, "The request's API budget is exhausted.")
 
+
+class ValidatorCache(StoredLRUCache):
+    """Stores the validators and bodies of GET responses.
+
+    Lets `GithubAPI` send conditional requests and replay the stored body when
+    Github answers with a 304, which does not count against the rate limit.
+    """
+    replay_headers = ('Content-Type', 'Link', 'ETag', 'Last-Modified')
+
+    def __init__(self, path=None, maxsize=64 * 1024 * 1024):
+        super().__init__(path, maxsize=maxsize, keep_evicted=False, lazy=True,
+                         getsizeof=lambda entry: len(entry['content']))
+        self.lock = RLock()
+
+    @staticmethod
+    def key(url, params=None):
+        return Request('GET', url, params=params).prepare().url
+
+    def entry(self, key) -> Optional[dict]:
+        """The stored response for a request, if any."""
+        with self.lock:
+            return self.get(key)
+
+    @staticmethod
+    def conditional_headers(entry: Optional[dict]) -> dict:
+        """The `If-None-Match`/`If-Modified-Since` headers for a request with the stored `entry`."""
+        if entry is None:
+            return {}
+        headers = {}
+        if 'ETag' in entry['headers']:
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if 'Last-Modified' in entry['headers']:
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        return headers
+
+    def store_response(self, key, resp: Response):
+        if 'ETag' not in resp.headers and 'Last-Modified' not in resp.headers:
+            return
+        entry = {
+            'headers': {h: resp.headers[h] for h in self.replay_headers if h in resp.headers},
+            'content': resp.content,
+            'encoding': resp.encoding
+        }
+        with self.lock:
+            try:
+                self[key] = entry
+            except ValueError:
+                pass
+
+    @staticmethod
+    def replay(entry: dict, resp: Response) -> Response:
+        """Builds a 200 response from the stored `entry` the 304 `resp` validated."""
+        replayed = Response()
+        replayed.status_code = 200
+        replayed.reason = 'OK'
+        replayed.url = resp.url
+        replayed.request = resp.request
+        replayed.encoding = entry['encoding']
+        replayed._content = entry['content']
+        replayed.headers.update(resp.headers)
+        replayed.headers.update(entry['headers'])
+        return replayed
+
+
+class Priority(IntEnum):
+    """How urgently a request is needed. Lower values win."""
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    REVALIDATE = 2
+
+request_priority: ContextVar[Priority] = ContextVar("request_priority", default=Priority.INTERACTIVE)
+
+@contextmanager
+def priority(level: Priority):
+    """Makes every API request in this context use `level`."""
+    token = request_priority.set(level)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class RequestBudget:
+    """The API requests and time one client request may spend.
+
+    Every thread working for the client request shares the budget through
+    `request_budget`. Once either is spent, further API requests raise
+    `RequestBudgetExhausted`, and the budget stays `exhausted`. Waits on
+    other work stop too once the deadline passes, see `deadline_passed`.
+
+    Args:
+        calls: Optional; The most API requests to send.
+        seconds: Optional; How long after the budget is created requests may still be sent.
+    """
+
+    def __init__(self, calls: Optional[int] = None, seconds: Optional[float] = None):
+        self.calls = calls
+        self.deadline = monotonic() + seconds if seconds else None
+        self.spent = 0
+        self.exhausted = False
+        self.lock = Lock()
+
+    def spend(self):
+        with self.lock:
+            if ((self.calls is not None and self.spent >= self.calls) or
+                (self.deadline is not None and monotonic() >= self.deadline)):
+                self.exhausted = True
+            if self.exhausted:
+                raise RequestBudgetExhausted()
+            self.spent += 1
+
+    def deadline_passed(self) -> bool:
+        """Whether the deadline has passed, marking the budget `exhausted` if it has."""
+        with self.lock:
+            if self.deadline is not None and monotonic() >= self.deadline:
+                self.exhausted = True
+                return True
+            return False
+
+request_budget: ContextVar[Optional[RequestBudget]] = ContextVar("request_budget", default=None)
+
+def budget_exhausted() -> bool:
+    """Whether the context's budget ran out."""
+    current = request_budget.get()
+    return current is not None and current.exhausted
+
+def deadline_passed() -> bool:
+    """Whether the context's budget's deadline has passed, for waits that spend no requests."""
+    current = request_budget.get()
+    return current is not None and current.deadline_passed()
+
+def check_deadline():
+    """Raises `RequestBudgetExhausted` if the context's budget's deadline has passed."""
+    if deadline_passed():
+        raise RequestBudgetExhausted()
+
+def seconds_left() -> float:
+    """The seconds until the context's budget's deadline, infinite without one."""
+    current = request_budget.get()
+    if current is None or current.deadline is None:
+        return float("inf")
+    return max(0.0, current.deadline - monotonic())
+
+@contextmanager
+def budget(limits: Optional[RequestBudget]):
+    """Makes every API request in this context spend from `limits`, or from nothing if it's None."""
+    token = request_budget.set(limits)
+    try:
+        yield
+    finally:
+        request_budget.reset(token)
+
+
+DEFAULT_LIMITS = {"core": 5000, "search": 30, "graphql": 5000}
+
+class RateLimitWindow:
+    """The rate limit Github reports for one resource (core, search, graphql)."""
+
+    def __init__(self, limit=5000):
+        self.limit = limit
+        self.remaining = limit
+        self.reset = datetime.now()
+
+    def update(self, headers):
+        try:
+            self.limit = int(headers['X-RateLimit-Limit'])
+            self.remaining = int(headers['X-RateLimit-Remaining'])
+            self.reset = datetime.fromtimestamp(int(headers['X-RateLimit-Reset']))
+        except (KeyError, ValueError):
+            pass
+
+    def roll_over(self):
+        """Assumes a full budget once the window's reset time has passed."""
+        if self.reset <= datetime.now() and self.remaining < self.limit:
+            self.remaining = self.limit
+
+
+class RequestScheduler:
+    """Hands out request slots across a pool of tokens by remaining budget.
+
+    Each token has its own rate limit window per resource. Every request goes
+    to the token with the most headroom for its resource.
+
+    Every priority but `INTERACTIVE` has a share of the window it must leave
+    untouched (`reserves`). Once even the best token is down to that share,
+    requests of that priority wait until a window resets, so background work
+    pauses long before interactive requests could be starved. Interactive
+    requests never wait: once no token has any headroom left they fail with
+    `GithubRateLimitExceeded` right away.
+    """
+    reserves = {
+        Priority.INTERACTIVE: 0.0,
+        Priority.BACKGROUND: 0.2,
+        Priority.REVALIDATE: 0.4,
+    }
+
+    def __init__(self, tokens: Optional[List[Optional[str]]] = None):
+        self.cond = Condition()
+        self.tokens = tokens or [None]
+        self.windows: Dict[Tuple[Optional[str], str], RateLimitWindow] = {}
+        self.inflight: Dict[Tuple[Optional[str], str], int] = {}
+
+    @staticmethod
+    def resource_for(url) -> str:
+        if "/search/" in url:
+            return "search"
+        if url.endswith("/graphql"):
+            return "graphql"
+        return "core"
+
+    def window(self, token, resource) -> RateLimitWindow:
+        with self.cond:
+            if (token, resource) not in self.windows:
+                self.windows[(token, resource)] = RateLimitWindow(DEFAULT_LIMITS.get(resource, 5000))
+            return self.windows[(token, resource)]
+
+    def headroom(self, token, resource) -> int:
+        """The requests left in the token's window that aren't already in flight."""
+        with self.cond:
+            window = self.window(token, resource)
+            window.roll_over()
+            return window.remaining - self.inflight.get((token, resource), 0)
+
+    def total_headroom(self, resource) -> int:
+        with self.cond:
+            return sum(self.headroom(token, resource) for token in self.tokens)
+
+    def next_reset(self, resource) -> datetime:
+        with self.cond:
+            return min(self.window(token, resource).reset for token in self.tokens)
+
+    def best_token(self, resource) -> Optional[str]:
+        with self.cond:
+            return max(self.tokens, key=lambda token: self.headroom(token, resource))
+
+    def available(self, resource, level: Priority) -> bool:
+        """Whether `level` may make a request to `resource` right now."""
+        with self.cond:
+            token = self.best_token(resource)
+            return self.headroom(token, resource) > self.reserves[level] * self.window(token, resource).limit
+
+    def acquire(self, resource, level: Priority) -> Optional[str]:
+        """Waits until `level` may make a request and returns the token to use.
+
+        Raises:
+            GithubRateLimitExceeded: `level` is `INTERACTIVE` and no token has headroom left.
+            RequestBudgetExhausted: The context's `request_budget` deadline passed while waiting.
+        """
+        with self.cond:
+            while True:
+                token = self.best_token(resource)
+                if self.available(resource, level):
+                    break
+                if level == Priority.INTERACTIVE:
+                    raise GithubRateLimitExceeded(self.window(token, resource).reset)
+                check_deadline()
+                wait = (self.next_reset(resource) - datetime.now()).total_seconds()
+                self.cond.wait(min(max(wait, 1), 60, seconds_left()))
+            self.inflight[(token, resource)] = self.inflight.get((token, resource), 0) + 1
+            return token
+
+    def release(self, token, resource, headers):
+        with self.cond:
+            self.inflight[(token, resource)] -= 1
+            self.window(token, headers.get('X-RateLimit-Resource', resource)).update(headers)
+            self.cond.notify_all()
+
+
+GRAPHQL_URL = "https://api.github.com/graphql"
 API_LOCK = RLock()
 class GithubAPI(Session):
     req_count = 0
 
     @property
     def req_remaining(self):
-        with API_LOCK:
-            return self._req_remaining
-
-    @req_remaining.setter
-    def req_remaining(self, remaining):
-        if type(remaining) is not int:
-            try:
-                remaining = int(remaining)
-            except:
-                return
-        with API_LOCK:
-            self._req_remaining = remaining
+        return self.scheduler.total_headroom("core")
 
     @property
     def req_reset(self):
-        with API_LOCK:
-            return self._req_reset
-
-    @req_reset.setter
-    def req_reset(self, reset):
-        if type(reset) is not int:
-            try:
-                reset = int(reset)
-            except:
-                return
-        with API_LOCK:
-            self._req_reset = datetime.fromtimestamp(reset)
+        return self.scheduler.next_reset("core")
 
     @property
     def counter(self):
@@ -77,25 +336,79 @@ class GithubAPI(Session):
         headers={
             'Accept':
             'application/vnd.github.v3+json, application/vnd.github.cloak-preview+json'
-        }):
+        },
+        pool_size=int(getenv("HTTP_POOL_SIZE", 32))):
         super().__init__()
-        self.req_remaining = 5000
-        self.req_reset = datetime.now().timestamp()
+        self.mount("https://", HTTPAdapter(pool_maxsize=pool_size))
+        self.scheduler = RequestScheduler()
         self.headers.update(headers)
+        self.validators = ValidatorCache(getenv("HTTP_CACHE_PATH", "data/http.cache"))
 
-    def get(self, *args, **kargs):
-        GithubAPI.add_request()
-        resp = super().get(*args, **kargs)
-        if 'X-RateLimit-Remaining' in resp.headers:
-            self.req_remaining = resp.headers['X-RateLimit-Remaining']
-            self.req_reset = resp.headers['X-RateLimit-Reset']
+    def get(self, url, params=None, **kargs):
+        """GETs `url`, revalidating any stored response for it.
+
+        A 304 from Github is turned back into a 200 carrying the stored body,
+        so callers never have to deal with conditional requests. The body is
+        replayed from the same stored entry the validators were taken from, even
+        if the entry is evicted meanwhile. The request waits for a slot from the
+        scheduler at the context's `request_priority`.
+        """
+        key = self.validators.key(url, params)
+        headers = dict(kargs.pop('headers', None) or {})
+        entry = self.validators.entry(key)
+        headers.update(self.validators.conditional_headers(entry))
+        resp, token = self.scheduled("GET", url, params=params, headers=headers, **kargs)
+        if resp.status_code == 304 and entry is not None:
+            resp = self.validators.replay(entry, resp)
+        elif resp.status_code == 200:
+            self.validators.store_response(key, resp)
         if resp.status_code >= 400:
-            self.handle_exception(resp)
+            self.handle_exception(resp, token)
         return resp
 
-    def handle_exception(self, resp):
-        if resp.status_code == 403 and self.req_remaining == 0:
-            raise GithubRateLimitExceeded(self.req_reset)
+    def graphql(self, query, variables=None) -> dict:
+        """Runs a GraphQL query and returns its `data`.
+
+        Raises:
+            GithubAPIException: The request failed or the query returned errors.
+        """
+        resp, token = self.scheduled("POST", GRAPHQL_URL, json={'query': query, 'variables': variables or {}})
+        if resp.status_code >= 400:
+            self.handle_exception(resp, token)
+        data = resp.json()
+        if data.get('errors') and data.get('data') is None:
+            raise GithubAPIException(502, data['errors'][0].get('message', "GraphQL query failed."))
+        return data['data']
+
+    def scheduled(self, method, url, headers=None, **kargs):
+        """Sends a request once the scheduler hands out a slot for it.
+
+        Returns:
+            The response and the token it was sent with.
+
+        Raises:
+            RequestBudgetExhausted: The context's `request_budget` is spent.
+        """
+        if (limits := request_budget.get()) is not None:
+            limits.spend()
+        GithubAPI.add_request()
+        headers = dict(headers or {})
+        resource = self.scheduler.resource_for(url)
+        token = self.scheduler.acquire(resource, request_priority.get())
+        if token is not None:
+            headers['Authorization'] = f"token {token}"
+        resp = None
+        try:
+            resp = self.request(method, url, headers=headers, **kargs)
+        finally:
+            self.scheduler.release(token, resource, resp.headers if resp is not None else {})
+        return resp, token
+
+    def handle_exception(self, resp, token=None):
+        resource = resp.headers.get('X-RateLimit-Resource', self.scheduler.resource_for(resp.url))
+        window = self.scheduler.window(token, resource)
+        if resp.status_code in (403, 429) and window.remaining == 0:
+            raise GithubRateLimitExceeded(window.reset)
         else:
             try:
                 data = resp.json()
@@ -105,6 +418,12 @@ class GithubAPI(Session):
             raise GithubAPIException(resp.status_code, message)
 
     def set_auth_token(self, token):
-        self.headers.update({"Authorization": f"token {token}"})
+        self.set_auth_tokens([token])
+
+    def set_auth_tokens(self, tokens):
+        """Spreads requests over a pool of tokens. Empty entries are ignored."""
+        tokens = [token for token in tokens if token]
+        with self.scheduler.cond:
+            self.scheduler.tokens = tokens or [None]
 
 api = GithubAPI()
\ No newline at end of file
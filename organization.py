@@ -2,6 +2,9 @@
 This module handles all actions pertaining to Github Organizations.
 """
 import pytz
+from hashlib import sha1
+from os import getenv
+from time import time
 from cache import StoredLRUCache
 from math import ceil
 from cachetools import cache
@@ -9,15 +12,212 @@ from cachetools import cache
 from cachetools.lru import LRUCache
 from utils import fetch_all
 from repository import Repository
-from github import api
-from typing import List
+from aggregate import OrgAggregate
+from resolver import graphql_resolver
+from planner import planner
+from records import Commit, Contributor
+from workers import flights, loader_pool
+from github import api, GithubAPIException, GithubRateLimitExceeded, Priority, priority, RequestBudgetExhausted
+from typing import Callable, List, Optional, Tuple, Union
 from datetime import datetime,timezone
 from threading import RLock, Thread
-from queue import Queue
 
-commitcache = StoredLRUCache(maxsize=100000, path="data/org.cache")
+commitcache = StoredLRUCache(maxsize=100000, path="data/org.cache", lazy=True)
 commitcache_lock = RLock()
 
+REPOLIST_TTL = int(getenv("REPOLIST_TTL", 10 * 60))
+REPOLIST_MAX_STALE = int(getenv("REPOLIST_MAX_STALE", 24 * 60 * 60))
+repolistcache = StoredLRUCache(maxsize=10000, path="data/repolist.cache", lazy=True)
+repolistcache_lock = RLock()
+repolist_revalidating = set()
+
+CHANGE_DETECTION = getenv("CHANGE_DETECTION", "listing")
+EVENTS_PER_PAGE = 100
+EVENTS_FEED_LIMIT = 300
+eventcursors = StoredLRUCache(maxsize=10000, path="data/events.cache", lazy=True)
+LISTING_EVENTS = {"CreateEvent", "PublicEvent"}
+
+SYNC_REPO_LIMIT = int(getenv("SYNC_REPO_LIMIT", 250))
+LAST_COMMIT_STRATEGY = getenv("LAST_COMMIT_STRATEGY", "scan")
+AGGREGATE_STORE_INTERVAL = 50
+
+def fetch_repository_list(orgname, poll=False) -> List[Tuple[str, str, datetime]]:
+    """Fetches the `(name, url, last_push)` listing of an org's repositories and caches it.
+
+    Concurrent fetches for the same org, in any process, share one listing.
+
+    Args:
+        orgname: The organization's login.
+        poll: Optional; If true and `CHANGE_DETECTION` is `events`, the cached
+            listing is brought up to date from the org's events if possible.
+    """
+    asked = time()
+    fetch = lambda: list_repositories(orgname, asked, poll)
+    listing, _ = flights.do(("repos", orgname), fetch, bypass=fetch)
+    return listing
+
+def newest_event(orgname) -> Optional[str]:
+    """The id of the newest event of an org, "0" if it has none, or None if they can't be read."""
+    try:
+        events = api.get(f"https://api.github.com/orgs/{orgname}/events",
+                         params={'per_page': EVENTS_PER_PAGE}).json()
+    except GithubAPIException:
+        return None
+    return events[0]['id'] if events else "0"
+
+def poll_events(orgname) -> Optional[List[Tuple[str, str, datetime]]]:
+    """Brings the cached listing of an org up to date from its events since the org's cursor.
+
+    The first events page is revalidated with its ETag, so an org without new
+    events costs one 304. An empty feed means nothing happened since either,
+    and if the feed was empty at the cursor, every event in it is new.
+    Only repositories that were pushed to get a new `last_push`, read from the
+    repository itself, so only those need loading.
+
+    Returns:
+        The updated listing, or None if a full listing is needed: there is no
+        cursor, the last full listing is older than `REPOLIST_MAX_STALE`, the
+        events no longer reach back to the cursor, a repository was added, or
+        refreshing the pushed repositories would cost more than listing them all.
+    """
+    with repolistcache_lock:
+        cached = repolistcache.get(orgname)
+        cursor = eventcursors.get(orgname)
+    if cached is None or cursor is None or cursor[0] is None or time() - cursor[1] > REPOLIST_MAX_STALE:
+        return None
+    last_id, listed_at = cursor
+    newest = None
+    pushed = set()
+    seen = 0
+    for event in fetch_all(f"https://api.github.com/orgs/{orgname}/events", per_page=EVENTS_PER_PAGE):
+        newest = newest or event['id']
+        seen += 1
+        if int(event['id']) <= int(last_id):
+            break
+        if event['type'] == "PushEvent":
+            pushed.add(event['repo']['url'])
+        elif event['type'] in LISTING_EVENTS and event['payload'].get('ref_type', "repository") == "repository":
+            return None
+    else:
+        # The feed ended before the cursor. Unless the feed was empty when the
+        # cursor was set and hasn't filled up since, events may have dropped out.
+        if newest is not None and (int(last_id) > 0 or seen >= EVENTS_FEED_LIMIT):
+            return None
+
+    listing = list(cached[1])
+    urls = {url: n for n, (_, url, _) in enumerate(listing)}
+    if not pushed.issubset(urls) or len(pushed) > ceil(len(listing) / 100):
+        return None
+    for url in pushed:
+        try:
+            repo = api.get(url).json()
+        except GithubAPIException:
+            return None
+        name, _, last_push = listing[urls[url]]
+        if repo['pushed_at'] is not None:
+            last_push = datetime.strptime(repo['pushed_at'], "%Y-%m-%dT%H:%M:%S%z")
+        listing[urls[url]] = (name, url, last_push)
+    with repolistcache_lock:
+        repolistcache[orgname] = (time(), listing)
+        eventcursors[orgname] = (newest or last_id, listed_at)
+    repolistcache.save()
+    eventcursors.save()
+    return listing
+
+def list_repositories(orgname, newer_than=None, poll=False) -> List[Tuple[str, str, datetime]]:
+    """Fetches the listing, unless another process has cached one since `newer_than`.
+
+    Args:
+        orgname: The organization's login.
+        newer_than: Optional; The time a cached listing must be newer than to be used.
+        poll: Optional; If true, tries `poll_events` before listing every repository.
+    """
+    if newer_than is not None:
+        with repolistcache_lock:
+            cached = repolistcache.get(orgname)
+        if cached is not None and cached[0] >= newer_than:
+            return cached[1]
+    events = CHANGE_DETECTION == "events"
+    if events and poll and (listing := poll_events(orgname)) is not None:
+        return listing
+    last_id = newest_event(orgname) if events else None
+    listing = []
+    for repo in fetch_all(f"https://api.github.com/orgs/{orgname}/repos", parallel=True):
+        if repo['pushed_at'] is not None:
+            last_push = datetime.strptime(repo['pushed_at'],
+                                        "%Y-%m-%dT%H:%M:%S%z")
+            listing.append((repo['name'], repo['url'], last_push))
+    with repolistcache_lock:
+        repolistcache[orgname] = (time(), listing)
+        if events:
+            eventcursors[orgname] = (last_id, time())
+    repolistcache.save()
+    if events:
+        eventcursors.save()
+    return listing
+
+def revalidate_repository_list(orgname):
+    """Refreshes the cached repository listing of an org on a background thread."""
+    with repolistcache_lock:
+        if orgname in repolist_revalidating:
+            return
+        repolist_revalidating.add(orgname)
+
+    def revalidate():
+        try:
+            with priority(Priority.REVALIDATE):
+                fetch_repository_list(orgname, poll=True)
+        except GithubAPIException as e:
+            print(f"Revalidating repositories of {orgname} failed: {e}")
+        finally:
+            with repolistcache_lock:
+                repolist_revalidating.discard(orgname)
+
+    Thread(target=revalidate, daemon=True).start()
+
+def repository_list(orgname, fresh=False, poll=False) -> List[Tuple[str, str, datetime]]:
+    """Returns the repository listing of an org, preferring the cached one.
+
+    A listing older than `REPOLIST_TTL` is still served but gets revalidated in the
+    background. Only a missing listing, or one older than `REPOLIST_MAX_STALE`, is
+    fetched on the calling thread.
+
+    Args:
+        orgname: The organization's login.
+        fresh: If true, skips the cache and fetches the listing right away.
+        poll: Optional; Passed on to `fetch_repository_list` when `fresh` is true.
+    """
+    with repolistcache_lock:
+        cached = None if fresh else repolistcache.get(orgname)
+    if cached is None:
+        return fetch_repository_list(orgname, poll=fresh and poll)
+    fetched_at, listing = cached
+    age = time() - fetched_at
+    if age > REPOLIST_MAX_STALE:
+        return fetch_repository_list(orgname)
+    if age > REPOLIST_TTL:
+        revalidate_repository_list(orgname)
+    return listing
+
+def listed_repository(orgname, url) -> Optional[Tuple[str, str, datetime]]:
+    """The `(name, url, last_push)` of a repository in the cached listing of an org, if it's there."""
+    with repolistcache_lock:
+        cached = repolistcache.get(orgname)
+    if cached is None:
+        return None
+    return next((entry for entry in cached[1] if entry[1] == url), None)
+
+def relist_repository(orgname, url, last_push: datetime):
+    """Moves a repository of the cached listing of an org to push `last_push`, e.g. on a webhook."""
+    with repolistcache_lock:
+        cached = repolistcache.get(orgname)
+        if cached is None:
+            return
+        fetched_at, listing = cached
+        repolistcache[orgname] = (fetched_at, [(name, url, last_push) if entry_url == url else (name, entry_url, push)
+                                               for name, entry_url, push in listing])
+    repolistcache.save()
+
 def uncache(usernames, org):
     with commitcache_lock:
         for username in usernames:
@@ -25,42 +225,59 @@ def uncache(usernames, org):
             if key in commitcache:
                 del commitcache[key]
 
-def load_last_commit(org, contributor):
+def load_cached_commit(org, contributor: Contributor) -> bool:
+    """Fills in a contributor's last commit from the org cache, if it's there."""
+    cachekey = f"{org.name}/{contributor.username}"
+    with commitcache_lock:
+        if cachekey not in commitcache:
+            return False
+        cached = commitcache[cachekey]
+    if isinstance(cached, dict):
+        cached = (cached['email'], Commit.from_value(cached['last_commit']))
+    contributor.email, contributor.last_commit = cached
+    return True
+
+def cache_commit(org, contributor: Contributor):
+    with commitcache_lock:
+        commitcache[f"{org.name}/{contributor.username}"] = (contributor.email, contributor.last_commit)
+
+def update_cached_commit(orgname: str, username: str, email: str, last_commit: Commit):
+    """Replaces a contributor's cached last commit in the org if `last_commit` is newer.
+
+    Contributors without a cached one are left to be resolved as usual.
+    """
+    cachekey = f"{orgname}/{username}"
+    with commitcache_lock:
+        cached = commitcache.get(cachekey)
+        if isinstance(cached, dict):
+            cached = (cached['email'], Commit.from_value(cached['last_commit']))
+        if cached is not None and (cached[1] is None or cached[1].date < last_commit.date):
+            commitcache[cachekey] = (email, last_commit)
+
+def load_last_commit(org, contributor: Contributor):
     """Loads a contributors last commit directly.
 
     This is much quicker than iterating through the commits.
-    The problem is, we only have approximately 30 req per minute on this endpoint so it is hard to determine when we should use it and when not to.
+    The problem is, we only have approximately 30 req per minute on this endpoint, so `planner` only
+    picks it when it saves enough core requests.
     """ 
-    cachekey = f"{org.name}/{contributor['username']}"
-    with commitcache_lock:
-        if cachekey in commitcache:
-            contributor['email'] = commitcache[cachekey]['email']
-            contributor['last_commit'] = commitcache[cachekey]['last_commit']
-            return
+    if load_cached_commit(org, contributor):
+        return
     url = "https://api.github.com/search/commits"
-    q = f"author:{contributor['username']} org:{org.name}"
+    q = f"author:{contributor.username} org:{org.name}"
     sort = "author-date"
     order = "desc"
     per_page = 1
     resp = api.get(url, params={'q': q, 'sort':sort, 'order':order, 'per_page': per_page})
     data = resp.json()
-    commit = data[0]
+    if len(data['items']) < 1:
+        return
+    commit = data['items'][0]
     commitdate = commit['commit']['author']['date']
     commitdate = datetime.strptime(commitdate,"%Y-%m-%dT%H:%M:%S%z")
-    commitmessage = commit['commit']['message']
-    email = commit['commit']['author']['email']
-
-    contributor['email'] = email
-    contributor['last_commit'] = {
-        "message": commitmessage,
-        "date": commitdate
-    }
-    with commitcache_lock:
-        commitcache[cachekey] = {
-            'email': contributor['email'],
-            'last_commit': contributor['last_commit']
-        }
-    
+    contributor.email = commit['commit']['author']['email']
+    contributor.last_commit = Commit(commit['commit']['message'], commitdate)
+    cache_commit(org, contributor)
 
 
 class OrganizationException(Exception):
@@ -75,86 +292,43 @@ class OrganizationNotFoundException(OrganizationException):
     """This exception is raised whenever an organization is not found"""
     pass
 
-class OrganizationTooLargeException(OrganizationException):
-    """This exception gets called when an organization has more than 250 repositories."""
-
-class RepoContribLoader(Thread):
-    @classmethod
-    def load(cls, repos, fn=lambda repo: repo.load_contributors()):
-        num_threads = len(repos)
-        inqueue = Queue()
-        outqueue = Queue()
-        threads = []
-        for repo in repos:
-            inqueue.put_nowait(repo)
-        for _ in range(num_threads):
-            t = RepoContribLoader(inqueue, outqueue, fn=fn)
-            threads.append(t)
-            t.start()
-        count = len(repos)
-        while count > 0:
-            repo = outqueue.get()
-            count -= 1
-            yield repo
-            outqueue.task_done()
-
-        for t in threads:
-            t.join()
-
-    def __init__(self,
-                inq,
-                outq,
-                fn=lambda repo: repo.load_contributors(),
-                *args,
-                **kargs):
-
-        self.inq = inq
-        self.outq = outq
-        self.fn = fn
-        super().__init__(*args, **kargs)
-
-    def run(self):
-        while self.inq.qsize() > 0:
-            repo = self.inq.get_nowait()
-            self.fn(repo)
-            self.outq.put_nowait(repo)
-            self.inq.task_done()
-
-
 class Organization:
 
-    daemon_threads = {}
     @property
     def endpoint(self) -> str:
         return f"https://api.github.com/orgs/{self.name}"
 
+    @property
+    def fully_loaded(self) -> bool:
+        """Whether every repository's contributors and their last commits are loaded."""
+        return all(map(lambda r: r.fully_loaded, self.repositories))
+
     @property
     def last_changed(self):
         return max(map(lambda r: r.last_push, self.repositories)).astimezone(pytz.timezone("GMT"))
 
-    def __init__(self, name: str, force_refresh=False):
+    @property
+    def version(self) -> str:
+        """Identifies the state of the org's repositories, which changes with any push, new or removed repository."""
+        pushes = "\n".join(sorted(f"{r.url} {r.last_push.isoformat()}" for r in self.repositories))
+        return f"{int(self.last_changed.timestamp())}-{sha1(pushes.encode()).hexdigest()[:12]}"
+
+    def __init__(self, name: str, force_refresh=False, revalidate=False):
         self.name = name
         self.repositories: List[Repository] = []
-        self.contributors: List[dict] = []
+        self.contributors: Union[List[Contributor], OrgAggregate] = []
         self.force_refresh = force_refresh
+        self.revalidate = revalidate
         self.contributors_loaded = False
-        if force_refresh:
-            if self.name in Organization.daemon_threads:
-                del Organization.daemon_threads[self.name]
+        self.completeness = 0.0
         self.load_repositories()
 
     def load_repositories(self):
         """Attempt to load the orgs repositories."""
 
-        for repo in fetch_all(f"{self.endpoint}/repos"):
-            name = repo['name']
-            url = repo['url']
-            if repo['pushed_at'] is not None:
-                last_push = datetime.strptime(repo['pushed_at'],
-                                            "%Y-%m-%dT%H:%M:%S%z")
-                self.repositories.append(Repository(name, url, last_push, self.force_refresh))
-        if len(self.repositories) > 250:
-            raise OrganizationTooLargeException(f"{self.name} has too many repositories to process.")
+        listing = repository_list(self.name, self.force_refresh or self.revalidate, poll=not self.force_refresh)
+        for name, url, last_push in listing:
+            self.repositories.append(Repository(name, url, last_push, self.force_refresh))
         for repo in self.repositories:
             if repo.needs_load and len(repo.contributors) > 0:
                 uncache(repo.contributors.keys(), self)
@@ -164,71 +338,166 @@ class Organization:
 
         return self.last_changed > dt
 
-    def load_contributors(self) -> List[dict]:
+    def load_contributors(self, limit=None) -> OrgAggregate:
         """Loads the orgs contributors sorted by number of contributions.
 
-        Loads the contributors from each repository then sorts them by total contributions.
+        Repositories are added to the org's persisted `OrgAggregate` as they finish loading, and
+        only repositories whose current push isn't part of it yet are loaded. A refreshed repository
+        only moves the contributors whose totals changed. If `limit` is set,
+        at most that many are loaded (most recently pushed first) and `completeness` tells how much
+        of the org the ranking covers; the rest is left to the background loader.
+        Loading also stops early, with a partial ranking, once the request budget is spent;
+        the repositories that finished loading by then are still added.
         The `last_commit` for each contributor is not loaded at this point. This is just to determine the order of contributors. The `last_commit` is loaded asynchronously or when that contributor is being included in a page of results. This allows for efficient(ish) paging of results.
+
+        Args:
+            limit: Optional; The most repositories to load before returning a partial ranking.
         """
         if not self.contributors_loaded:
-            contributors = {}
-            for repo in iter(RepoContribLoader.load(self.repositories)):
-                for n, contributor in repo.contributors.items():
-                    if n not in contributors:
-                        contributors[n] = dict(contributor)
-                        contributors[n]['last_commit'] = None
-                    else:
-                        contributors[n]["contributions"] += contributor["contributions"]
-            self.contributors = sorted(contributors.values(), key=lambda c: c['contributions'], reverse=True)
+            aggregate = OrgAggregate.load(self.name, fresh=self.force_refresh)
+            aggregate.retain(self.repositories)
+            pending = sorted((repo for repo in self.repositories if not aggregate.includes(repo)),
+                             key=lambda repo: repo.last_push, reverse=True)
+            if limit is not None:
+                pending = pending[:limit]
+            failure = None
+            added = 0
+            for repo, error in loader_pool.outcomes(pending, lambda repo: repo.load_contributors()):
+                if error is not None:
+                    if not isinstance(error, RequestBudgetExhausted):
+                        failure = failure or error
+                    continue
+                aggregate.add(repo)
+                added += 1
+                if added % AGGREGATE_STORE_INTERVAL == 0:
+                    aggregate.store()
+            if pending:
+                aggregate.store()
+            if failure is not None:
+                raise failure
+            self.contributors = aggregate
+            self.completeness = aggregate.completeness(self.repositories)
             self.contributors_loaded = True
         return self.contributors
 
-    def get_top_contributors(self, count=None, page=1):
+    def get_top_contributors(self, count=None, page=1, limit=None):
         """Load the top contributors for the org.
 
         Get the top `count` contributors, offset by `count * (page - 1)`.
-        Load the last commit for each top contributor in each repository, if it exists.
+        Load the last commit for each top contributor in each loaded repository, if it exists.
         Find the most recent one among all the repos and include that one in the contributor's object.
         return the contributors.
 
         Args:
             count: The number of contributors to return.
             page: The page number to return. Uses count to determine offset.
+            limit: Optional; Passed on to `load_contributors`.
         """
 
-        self.load_contributors()
+        self.load_contributors(limit)
+        top_contributors, num_pages = self.ranking_page(count, page)
+        return self.load_last_commits(top_contributors), num_pages
+
+    def ranking_page(self, count=None, page=1) -> Tuple[List[Contributor], int]:
+        """Copies of the loaded ranking's contributors at `page`, without last commits, and the number of pages."""
         count = count or len(self.contributors)
         end = page * count
         start = end - count
         num_pages = ceil(len(self.contributors)/count)
         if page < 1 or page > num_pages:
             return [], num_pages
-        top_contributors = self.contributors[start:end]
-        have_last = set([contrib['username'] for contrib in top_contributors if contrib['last_commit'] is not None])
-
-        req_logins = set(map(lambda contrib: contrib['username'], top_contributors)).difference(have_last)
-        fn = lambda repo: repo.load_last_commits(only=req_logins)
-        for repo in RepoContribLoader.load(self.repositories, fn):
-            for contrib in top_contributors:
-                if contrib['username'] in repo.contributors:
-                    repo_contrib = repo.contributors[contrib['username']]
-                    try:
-                        if (contrib['last_commit'] is None or
-                            contrib['last_commit']['date'] < repo_contrib['last_commit']['date']):
-                            contrib['last_commit'] = repo_contrib['last_commit']
-                            contrib['email'] = repo_contrib['email']
-                    except:
-                        print(f"Failed: {repo.name}, {contrib['username']}")
-                        print(repo_contrib)
-
-        return top_contributors, num_pages
-
-    def daemon_loader(self):
-        """Starts a cache pre-loader daemon"""
-
-        if (not all(map(lambda r: r.fully_loaded, self.repositories)) and
-            self.name not in Organization.daemon_threads):
-            t = Thread(target=self.get_top_contributors, daemon=True)
-            t.start()
-            Organization.daemon_threads[self.name] = t
+        return [contrib.copy() for contrib in self.contributors[start:end]], num_pages
 
+    def load_last_commits(self, top_contributors: List[Contributor],
+                          on_resolved: Optional[Callable[[Contributor], None]] = None) -> List[Contributor]:
+        """Fills in each contributor's most recent last commit among the org's loaded repositories.
+
+        Contributors whose search runs into the search rate limit are resolved
+        from the repositories instead.
+
+        Args:
+            top_contributors: Records without a last commit, e.g. one page of the ranking.
+            on_resolved: Optional; Called with each contributor as soon as their last commit is final,
+                i.e. it was cached or found by search, or every repository they contributed to is done.
+                Contributors it wasn't called for when the request budget ran out are still pending.
+        """
+        resolved = on_resolved or (lambda contrib: None)
+        by_login = {contrib.username: contrib for contrib in top_contributors}
+        cached = set(contrib.username for contrib in top_contributors if load_cached_commit(self, contrib))
+        have_last = set([contrib.username for contrib in top_contributors if contrib.last_commit is not None])
+        for login in have_last:
+            resolved(by_login[login])
+
+        req_logins = set(map(lambda contrib: contrib.username, top_contributors)).difference(have_last)
+        repos = [repo for repo in self.repositories
+                 if not repo.needs_load and not req_logins.isdisjoint(repo.contributors)]
+        plan = planner.plan_organization(self, req_logins, cached, repos)
+        try:
+            searched = [contrib for contrib in top_contributors if contrib.username in plan.search]
+            for contrib, error in loader_pool.outcomes(searched, lambda contrib: load_last_commit(self, contrib)):
+                if isinstance(error, (GithubRateLimitExceeded, RequestBudgetExhausted)):
+                    continue
+                if error is not None:
+                    raise error
+                if contrib.last_commit is not None:
+                    req_logins.discard(contrib.username)
+                    resolved(contrib)
+            repos = [repo for repo in repos if not req_logins.isdisjoint(repo.contributors)]
+            if LAST_COMMIT_STRATEGY == "graphql":
+                self.resolve_last_commits(repos, req_logins)
+
+            members = {repo.url: req_logins.intersection(repo.contributors) for repo in repos}
+            pending = dict((login, 0) for login in req_logins)
+            for logins in members.values():
+                for login in logins:
+                    pending[login] += 1
+            for login in [login for login, count in pending.items() if count == 0]:
+                del pending[login]
+                resolved(by_login[login])
+
+            fn = lambda repo: (repo.load_contributors(), repo.load_last_commits(only=req_logins))
+            for repo, error in loader_pool.outcomes(repos, fn):
+                if isinstance(error, RequestBudgetExhausted):
+                    continue
+                if error is not None:
+                    raise error
+                for login in members[repo.url]:
+                    contrib = by_login[login]
+                    repo_contrib = repo.contributors.get(login)
+                    if (repo_contrib is not None and repo_contrib.last_commit is not None and
+                        (contrib.last_commit is None or contrib.last_commit.date < repo_contrib.last_commit.date)):
+                        contrib.last_commit = repo_contrib.last_commit
+                        contrib.email = repo_contrib.email
+                    pending[login] -= 1
+                    if pending[login] == 0:
+                        if self.completeness == 1 and contrib.last_commit is not None:
+                            cache_commit(self, contrib)
+                        resolved(contrib)
+        except RequestBudgetExhausted:
+            pass
+        return top_contributors
+
+    def resolve_last_commits(self, repos: List[Repository], logins: set):
+        """Fills in the missing last commits of `logins` in `repos` with batched GraphQL queries.
+
+        Anything this doesn't resolve is left to the regular commit scan.
+        """
+        pairs = {}
+        for repo in repos:
+            for login in logins.intersection(repo.contributors):
+                if repo.contributors[login].last_commit is None:
+                    pairs[(repo.url, login)] = repo
+        try:
+            found = graphql_resolver.resolve(pairs.keys())
+        except RequestBudgetExhausted:
+            raise
+        except GithubAPIException as e:
+            print(f"Resolving last commits of {self.name} through GraphQL failed: {e}")
+            return
+        for (url, login), (email, last_commit) in found.items():
+            repo = pairs[(url, login)]
+            repo.contributors[login].email = email
+            repo.contributors[login].last_commit = last_commit
+            repo.contrib_need_update.discard(login)
+        for repo in set(pairs[pair] for pair in found):
+            repo.store()
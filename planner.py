@@ -0,0 +1,154 @@
+"""
+This module plans how to resolve contributors' last commits for the least API cost.
+"""
+import json
+from collections import deque
+from math import ceil
+from os import getenv
+from threading import RLock
+from time import time
+from typing import Dict, Iterable, List, Set
+from github import api
+
+WINDOW_SECONDS = {"core": 60 * 60, "search": 60, "graphql": 60 * 60}
+DIRECT_REQUESTS = 1.2
+DIRECT_MAX_LOOKUPS = int(getenv("DIRECT_MAX_LOOKUPS", 10))
+SCAN_OVERRUN = 2
+
+
+class RepositoryPlan:
+    """How to resolve the needed last commits of one repository.
+
+    `scan` are found by walking the commits for at most about `scan_pages`
+    pages, `direct` by one `/commits?author=` lookup each.
+    """
+
+    def __init__(self, scan: Set[str], direct: Set[str], scan_pages: int, cost: float):
+        self.scan = scan
+        self.direct = direct
+        self.scan_pages = scan_pages
+        self.cost = cost
+
+
+class OrganizationPlan:
+    """Which needed last commits come from the org cache, the search API or the repositories."""
+
+    def __init__(self, cached: Set[str], search: Set[str], repository: Set[str]):
+        self.cached = cached
+        self.search = search
+        self.repository = repository
+
+
+class LastCommitPlanner:
+    """Picks the cheapest mix of strategies to resolve contributors' last commits.
+
+    A request is priced as the share of its resource's remaining budget it
+    uses up, scaled by how long that resource's window is. So the scarce
+    search API only wins when it replaces several core requests, and it gets
+    pricier as its budget runs down.
+
+    Every decision is kept in `decisions`, and appended as a JSON line to
+    `log_path` if set, for tuning.
+    """
+
+    def __init__(self, log_path=getenv("PLANNER_LOG"), history=1000):
+        self.log_path = log_path
+        self.decisions = deque(maxlen=history)
+        self.lock = RLock()
+
+    def price(self, resource) -> float:
+        """The cost of one request to `resource`, in hours of a full budget."""
+        headroom = max(api.scheduler.total_headroom(resource), 1)
+        return WINDOW_SECONDS[resource] / (60 * 60 * headroom)
+
+    @staticmethod
+    def expected_pages(total: int, contributions: int) -> int:
+        """The pages a newest-first scan reads until it meets one of `contributions` commits among `total`."""
+        return max(1, ceil(total / ((contributions + 1) * 100)))
+
+    def split(self, repo, needed: Iterable[str], total: int):
+        """Finds the cheapest split of `needed` between a shared commit scan and per-author lookups.
+
+        The scan is paid once, up to the deepest contributor it has to reach, so
+        it takes the contributors expected closest to the top. At most
+        `DIRECT_MAX_LOOKUPS` contributors are looked up.
+
+        Returns:
+            The cost in core requests, and the `(expected pages, username)` of the
+            contributors to scan and to look up.
+        """
+        pages = sorted((self.expected_pages(total, repo.contributors[username].contributions), username)
+                       for username in needed)
+        least = max(0, len(pages) - DIRECT_MAX_LOOKUPS)
+        best = (float("inf"), least)
+        for k in range(least, len(pages) + 1):
+            cost = (pages[k - 1][0] if k else 0) + (len(pages) - k) * DIRECT_REQUESTS
+            if cost < best[0]:
+                best = (cost, k)
+        cost, k = best
+        return cost, pages[:k], pages[k:]
+
+    def plan_repository(self, repo, needed: Iterable[str]) -> RepositoryPlan:
+        """Splits `needed` between a shared commit scan and per-author lookups."""
+        total = sum(contrib.contributions for contrib in repo.contributors.values())
+        cost, scan, direct = self.split(repo, needed, total)
+        plan = RepositoryPlan(
+            scan=set(username for _, username in scan),
+            direct=set(username for _, username in direct),
+            scan_pages=scan[-1][0] if scan else 0,
+            cost=cost * self.price("core"))
+        self.record(scope="repository", name=repo.url, needed=len(scan) + len(direct), scan=len(plan.scan),
+                    direct=len(plan.direct), scan_pages=plan.scan_pages, cost=plan.cost)
+        return plan
+
+    def plan_organization(self, org, needed: Iterable[str], cached: Set[str], repos: List) -> OrganizationPlan:
+        """Decides per contributor between one search request and resolving them per repository.
+
+        A contributor's per repository cost is their even share of each
+        repository's cheapest plan for everyone still needed there. Searches
+        are planned for at most as many contributors as the search rate limit
+        has requests left, those with the dearest estimates first.
+
+        Args:
+            org: The organization.
+            needed: The logins whose last commit is needed.
+            cached: The logins of `needed` that are in the org cache.
+            repos: The loaded repositories to resolve from.
+        """
+        core, search = self.price("core"), self.price("search")
+        needed = set(needed).difference(cached)
+        estimates: Dict[str, float] = dict((username, 0.0) for username in needed)
+        for repo in repos:
+            missing = [username for username in needed.intersection(repo.contributors)
+                       if repo.contributors[username].last_commit is None]
+            if missing:
+                total = sum(c.contributions for c in repo.contributors.values())
+                cost, _, _ = self.split(repo, missing, total)
+                for username in missing:
+                    estimates[username] += cost * core / len(missing)
+        plan = OrganizationPlan(set(cached), set(), set())
+        headroom = api.scheduler.total_headroom("search")
+        for username, estimate in sorted(estimates.items(), key=lambda item: -item[1]):
+            if estimate > search and len(plan.search) < headroom:
+                plan.search.add(username)
+            else:
+                plan.repository.add(username)
+        self.record(scope="organization", name=org.name, cached=len(plan.cached), search=len(plan.search),
+                    repository=len(plan.repository), search_price=search, core_price=core,
+                    cost=sum(search if username in plan.search else estimate
+                             for username, estimate in estimates.items()))
+        return plan
+
+    def record(self, **decision):
+        decision['time'] = time()
+        with self.lock:
+            self.decisions.append(decision)
+            if self.log_path:
+                try:
+                    with open(self.log_path, "a") as log:
+                        log.write(json.dumps(decision) + "\n")
+                except OSError as e:
+                    print(f"Writing planner decision failed: {e}")
+
+
+planner = LastCommitPlanner()
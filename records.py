@@ -0,0 +1,66 @@
+"""
+This module holds the compact records contributors and their commits are kept in.
+"""
+from datetime import datetime
+from sys import intern
+from typing import Optional
+
+
+def intern_str(value: Optional[str]) -> Optional[str]:
+    """Interns `value` so the same login, email or avatar url is stored once across repositories."""
+    return intern(value) if isinstance(value, str) else value
+
+
+class Commit:
+    """A contributor's last commit."""
+    __slots__ = ('message', 'date')
+
+    def __init__(self, message: str, date: datetime):
+        self.message = message
+        self.date = date
+
+    def __reduce__(self):
+        return (Commit, (self.message, self.date))
+
+    @classmethod
+    def from_value(cls, value) -> Optional["Commit"]:
+        """Converts a `{"message", "date"}` dict from an older cache entry."""
+        if value is None or isinstance(value, Commit):
+            return value
+        return cls(value['message'], value['date'])
+
+
+class Contributor:
+    """A contributor of a repository, or their totals across an organization.
+
+    Logins, emails and avatar urls are interned, and records pickle as a plain
+    tuple of their fields, which keeps both memory and cache files small.
+    """
+    __slots__ = ('username', 'email', 'image', 'contributions', 'last_commit')
+
+    def __init__(self,
+                 username: str,
+                 email: Optional[str],
+                 image: str,
+                 contributions: int,
+                 last_commit: Optional[Commit] = None):
+        self.username = intern_str(username)
+        self.email = intern_str(email)
+        self.image = intern_str(image)
+        self.contributions = contributions
+        self.last_commit = last_commit
+
+    def __reduce__(self):
+        return (Contributor, (self.username, self.email, self.image, self.contributions, self.last_commit))
+
+    @classmethod
+    def from_value(cls, value) -> "Contributor":
+        """Converts a contributor dict from an older cache entry."""
+        if isinstance(value, Contributor):
+            return value
+        return cls(value['username'], value['email'], value['image'], value['contributions'],
+                   Commit.from_value(value['last_commit']))
+
+    def copy(self) -> "Contributor":
+        """A copy without email or last commit, e.g. for one page of results."""
+        return Contributor(self.username, None, self.image, self.contributions)
@@ -0,0 +1,149 @@
+"""
+This module keeps the rankings of popular Github Organizations warm in the background.
+"""
+from cache import StoredLRUCache
+from os import getenv
+from threading import Event, RLock, Thread
+from time import time
+from typing import List, Optional
+from github import api, GithubAPIException, Priority, priority
+from organization import Organization
+from snapshot import RankingSnapshot, SNAPSHOT_TTL
+from workers import ProcessLock
+
+REFRESH_HALF_LIFE = 24 * 60 * 60
+REFRESH_MIN_SCORE = float(getenv("REFRESH_MIN_SCORE", 3))
+REFRESH_LEAD = int(getenv("REFRESH_LEAD", 5 * 60))
+REFRESH_TICK = 10
+REFRESH_PAGE = 100
+
+
+def load_fully(name: str, level=Priority.BACKGROUND) -> RankingSnapshot:
+    """Loads an org's complete ranking and every last commit into its snapshot.
+
+    Args:
+        name: The org's login.
+        level: Optional; The priority of the API requests.
+    """
+    with priority(level):
+        org = Organization(name, revalidate=True)
+        org.load_contributors()
+        snapshot = RankingSnapshot.take(org)
+        for offset in range(0, len(snapshot), REFRESH_PAGE):
+            if snapshot.unresolved(offset, REFRESH_PAGE):
+                page = [contrib.copy() for contrib in snapshot.page(offset, REFRESH_PAGE)]
+                snapshot.fill(offset, org.load_last_commits(page))
+                snapshot.store()
+    return snapshot
+
+
+class RefreshJob:
+    """An org's popularity and when its ranking is next due to be loaded."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.score = 0.0
+        self.last_hit = time()
+        self.due: Optional[float] = None
+
+    def popularity(self, now: float) -> float:
+        """The org's requests, each one counting half as much every `REFRESH_HALF_LIFE` seconds."""
+        return self.score * 0.5 ** ((now - self.last_hit) / REFRESH_HALF_LIFE)
+
+
+class RefreshScheduler:
+    """Loads orgs in the background, most popular first.
+
+    An org that wasn't completely loaded by a request is loaded in full right
+    after it. Orgs with a popularity of at least `REFRESH_MIN_SCORE` are also
+    revalidated `REFRESH_LEAD` seconds before their latest snapshot expires,
+    so they are almost always served warm.
+
+    Jobs live in a store shared by every process on the host and outlast
+    restarts, and each one runs in one process at a time. A job only starts
+    while the core rate limit has room for background requests, otherwise it
+    waits for the window to reset.
+    """
+
+    def __init__(self, path="data/refresh.cache"):
+        self.jobs = StoredLRUCache(maxsize=10000, path=path, keep_evicted=False, lazy=True)
+        self.lock = RLock()
+        self.wakeup = Event()
+        self.thread: Optional[Thread] = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def next_due(self, job: RefreshJob, now: float) -> Optional[float]:
+        """When a loaded org is next due, if it's popular enough to keep warm."""
+        if job.popularity(now) < REFRESH_MIN_SCORE:
+            return None
+        return now + SNAPSHOT_TTL - REFRESH_LEAD
+
+    def record_request(self, name: str, org: Optional[Organization] = None):
+        """Counts a request for org `name`, and schedules it if it needs loading.
+
+        Args:
+            name: The org's login.
+            org: Optional; The org as the request left it, if it built one.
+        """
+        now = time()
+        with self.lock:
+            job = self.jobs.get(name) or RefreshJob(name)
+            job.score = job.popularity(now) + 1
+            job.last_hit = now
+            if org is not None and (org.completeness < 1 or not org.fully_loaded):
+                job.due = now
+            elif job.due is None:
+                job.due = self.next_due(job, now)
+            self.jobs[name] = job
+        if job.due is not None and job.due <= now:
+            self.wakeup.set()
+
+    def due_jobs(self, now: float) -> List[RefreshJob]:
+        with self.lock:
+            self.jobs.refresh()
+            jobs = [self.jobs.get(name) for name in list(self.jobs.stored_keys)]
+        due = [job for job in jobs if job is not None and job.due is not None and job.due <= now]
+        return sorted(due, key=lambda job: job.popularity(now), reverse=True)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(REFRESH_TICK)
+            self.wakeup.clear()
+            for job in self.due_jobs(time()):
+                if not api.scheduler.available("core", Priority.BACKGROUND):
+                    break
+                self.refresh(job.name)
+
+    def refresh(self, name: str):
+        """Runs `load_fully` for the org, unless another process is already refreshing it."""
+        lock = ProcessLock(("refresh", name))
+        if not lock.acquire(blocking=False):
+            return
+        status = None
+        try:
+            load_fully(name)
+        except GithubAPIException as e:
+            print(f"Refreshing {name} failed: {e}")
+            status = e.status_code
+        except Exception as e:
+            print(f"Refreshing {name} failed: {e}")
+        finally:
+            lock.release()
+
+        with self.lock:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            if status == 404:
+                del self.jobs[name]
+                return
+            job.due = self.next_due(job, time())
+            self.jobs[name] = job
+
+
+refresh_scheduler = RefreshScheduler()
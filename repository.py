@@ -4,13 +4,15 @@ This module handles all actions pertaining to Github Repositories.
 
 from cache import StoredLRUCache
 from datetime import datetime, timezone
-from math import ceil
-from typing import Optional
-from utils import fetch_all, fetch_async
+from typing import Dict, List, Optional, Tuple
+from utils import fetch_all, fetch_pages
 from cachetools import LRUCache
-from collections import OrderedDict
-from threading import RLock, Thread
-from github import api
+from collections import Counter, OrderedDict
+from threading import RLock
+from github import api, RequestBudgetExhausted
+from workers import flights, lookup_pool
+from planner import planner, DIRECT_MAX_LOOKUPS, SCAN_OVERRUN
+from records import Commit, Contributor, intern_str
 
 class RepositoryException(Exception):
     def __init__(self, message):
@@ -18,38 +20,102 @@ class RepositoryException(Exception):
     def __str__(self):
         return self.message
 
+SINCE_MAX_PAGES = 10
+PUSH_MAX_COMMITS = 2048
+
 def contributor_count(contrib):
     """Cache helper method to determine size of contributors cache"""
     return len(contrib[1])
 
-def load_last_commit(repo, contributor):
+def track_head(pages, head):
+    """Yields commit `pages`, recording the sha and date of the first commit in `head`."""
+    for page in pages:
+        if not head and page:
+            head.append((page[0]['sha'], page[0]['commit']['committer']['date']))
+        yield page
+
+def match_commits(page, wanted: set) -> Dict[str, Tuple[dict, str]]:
+    """Finds the newest commit of each login of `wanted` in a page of commits.
+
+    A commit counts for its author's login, or else for its committer's. Matched
+    logins are removed from `wanted`, so each commit costs one or two set lookups
+    however many logins are wanted, and the rest of the page is skipped once
+    `wanted` is empty.
+
+    Returns:
+        The matched `(commit, "author" or "committer")` keyed by login.
+    """
+    found = {}
+    for commit in page:
+        author = commit['author']
+        login = author['login'] if author else None
+        if login in wanted:
+            cmauthor = "author"
+        else:
+            committer = commit['committer']
+            login = committer['login'] if committer else None
+            if login not in wanted:
+                continue
+            cmauthor = "committer"
+        wanted.remove(login)
+        found[login] = (commit, cmauthor)
+        if not wanted:
+            break
+    return found
+
+def parse_commit(commit, cmauthor) -> Tuple[str, Commit]:
+    """Returns the email and the last_commit record of `commit` for its `cmauthor` role."""
+    commitdate = commit['commit'][cmauthor]['date']
+    commitdate = datetime.strptime(commitdate,"%Y-%m-%dT%H:%M:%S%z")
+    return commit['commit'][cmauthor]['email'], Commit(commit['commit']['message'], commitdate)
+
+def push_commits(commits: List[dict]) -> Tuple[Counter, Dict[str, Tuple[str, Commit]]]:
+    """Reads the commits of a `push` webhook payload, oldest first.
+
+    Returns:
+        The number of commits each login authored, and the login -> `(email, last_commit)`
+        of the newest commit of each author and committer.
+    """
+    counts = Counter(commit['author'].get('username') for commit in commits)
+    counts.pop(None, None)
+    newest = {}
+    for commit in reversed(commits):
+        date = datetime.strptime(commit['timestamp'], "%Y-%m-%dT%H:%M:%S%z").astimezone(timezone.utc)
+        for cmauthor in ("author", "committer"):
+            login = intern_str(commit[cmauthor].get('username'))
+            if login is not None and login not in newest:
+                newest[login] = (commit[cmauthor]['email'], Commit(commit['message'], date))
+    return counts, newest
+
+def as_records(contributors):
+    """Converts the contributor dicts of an older cache entry to `Contributor` records."""
+    if contributors and not isinstance(next(iter(contributors.values())), Contributor):
+        return OrderedDict((intern_str(username), Contributor.from_value(contrib))
+                           for username, contrib in contributors.items())
+    return contributors
+
+def load_last_commit(repo, contributor: Contributor):
     url = f"{repo.url}/commits"
     cmauthor = "author"
     def get_commit():
         resp = api.get(url,
-                    params={cmauthor:contributor['username'], 'per_page': 1})
+                    params={cmauthor:contributor.username, 'per_page': 1})
         return resp.json()
     commits = get_commit()
     if len(commits) < 1:
         cmauthor = "committer"
         commits = get_commit()
+    if len(commits) < 1:
+        return
 
-    commit = commits[0]
-    commitdate = commit['commit'][cmauthor]['date']
-    commitdate = datetime.strptime(commitdate,"%Y-%m-%dT%H:%M:%S%z")
-    commitmessage = commit['commit']['message']
-    email = commit['commit'][cmauthor]['email']
-
-    contributor['email'] = email
-    contributor['last_commit'] = {
-        "message": commitmessage,
-        "date": commitdate
-    }
+    contributor.email, contributor.last_commit = parse_commit(commits[0], cmauthor)
 
 
 class Repository:
-    cache = StoredLRUCache(maxsize=10000, getsizeof=contributor_count, path="data/repository.cache")
+    cache = StoredLRUCache(maxsize=10000, getsizeof=contributor_count, path="data/repository.cache", lazy=True,
+                           seed="data/seed/repository.pickle")
     cachelock = RLock()
+    commit_iters = {}
     @property
     def fully_loaded(self):
         return (not self.needs_load and 
@@ -61,14 +127,31 @@ class Repository:
 
     @cachesize.setter
     def set_cachesize(cls, newsize):
-        cls.cache = StoredLRUCache(maxsize=newsize, getsizeof=contributor_count, path=Repository.cache.savepath)
+        cls.cache = StoredLRUCache(maxsize=newsize, getsizeof=contributor_count, path=Repository.cache.savepath, lazy=True,
+                                   seed=Repository.cache.seed)
+
+    @property
+    def commit_pages(self):
+        """The repository's iterator of commit pages, shared by every instance of the same push.
+
+        Only used by the leader of a `last_commits` flight, so one thread at a time.
+        """
+        with Repository.cachelock:
+            last_push, pages, _ = Repository.commit_iters.get(self.url, (None, None, None))
+            if pages is None or last_push != self.last_push:
+                head = []
+                pages = track_head(fetch_pages(f"{self.url}/commits"), head)
+                Repository.commit_iters[self.url] = (self.last_push, pages, head)
+        return pages
 
     @property
-    def commit_iter(self):
-        if "_commit_iter" not in self.__dict__:
-            self._commit_iter = iter(fetch_all(f"{self.url}/commits"))
-            # self._commit_iter = iter(fetch_async(f"{self.url}/commits"))
-        return self._commit_iter
+    def commit_head(self) -> Optional[Tuple[str, str]]:
+        """The `(sha, date)` of the newest commit `commit_pages` has yielded, if any."""
+        with Repository.cachelock:
+            last_push, _, head = Repository.commit_iters.get(self.url, (None, None, None))
+        if last_push != self.last_push or not head:
+            return None
+        return head[0]
 
     def __init__(self,
                 name: str,
@@ -88,13 +171,16 @@ class Repository:
         """
 
         c_last_push = None
-        contributors = OrderedDict()
+        contributors: Dict[str, Contributor] = OrderedDict()
+        high_water = None
         try:
             with Repository.cachelock:
                 if force_refresh:
                     del Repository.cache[url]
                 else:
-                    c_last_push, contributors = Repository.cache[url]
+                    entry = Repository.cache[url]
+                    c_last_push, contributors = entry[0], as_records(entry[1])
+                    high_water = entry[2] if len(entry) > 2 else None
         except KeyError:
             pass
 
@@ -104,12 +190,72 @@ class Repository:
         self.needs_load = c_last_push != last_push
         self.contributors = contributors
         self.contrib_need_update = set()
+        self.high_water: Optional[Tuple[str, str]] = high_water
 
     def store(self):
         with Repository.cachelock:
-            Repository.cache[self.url] = (self.last_push, self.contributors)
-            Repository.cache.save()
+            Repository.cache[self.url] = (self.last_push, self.contributors, self.high_water)
+
+    def sync(self):
+        """Adopts the cached contributors if they were stored for our `last_push`.
+
+        Used after waiting on another instance's load of the same repository.
+        """
+        with Repository.cachelock:
+            entry = Repository.cache.get(self.url)
+        if entry is not None and entry[0] == self.last_push:
+            self.contributors = as_records(entry[1])
+            self.high_water = entry[2] if len(entry) > 2 else None
+            self.needs_load = False
+            self.contrib_need_update = set(
+                username for username, contrib in self.contributors.items()
+                if contrib.last_commit is None)
+
 
+    def apply_push(self, push: dict, last_push: datetime) -> Optional[Dict[str, Tuple[str, Commit]]]:
+        """Applies a `push` webhook payload to the loaded contributors, as of push `last_push`.
+
+        Each commit pushed to the default branch counts for its author, and the
+        newest one of each author and committer becomes their last commit, like
+        a commit scan would find. Pushes to other branches only move `last_push`.
+        Nothing changes if the push can't be applied exactly: the contributors
+        aren't loaded, history was rewritten, the commits were truncated, one of
+        them is by someone who isn't a contributor yet, or there's no high water
+        mark showing the push starts where the loaded counts end.
+
+        Returns:
+            The login -> `(email, last_commit)` of the push's newest commits, or None if it wasn't applied.
+        """
+        branch = push['repository'].get('default_branch') or push['repository'].get('master_branch')
+        if self.needs_load:
+            return None
+        if push['ref'] != f"refs/heads/{branch}":
+            self.last_push = last_push
+            return {}
+        commits = push['commits']
+        if push['forced'] or push['created'] or push['deleted'] or len(commits) >= PUSH_MAX_COMMITS:
+            return None
+        if self.high_water is None or self.high_water[0] != push['before']:
+            return None
+        counts, newest = push_commits(commits)
+        if any(login not in self.contributors for login in counts):
+            return None
+
+        newest = {login: found for login, found in newest.items() if login in self.contributors}
+        contributors = OrderedDict()
+        for username, contrib in self.contributors.items():
+            email, last_commit = contrib.email, contrib.last_commit
+            if username in newest and (last_commit is None or last_commit.date <= newest[username][1].date):
+                email, last_commit = newest[username]
+                self.contrib_need_update.discard(username)
+            contributors[username] = Contributor(username, email, contrib.image,
+                                                 contrib.contributions + counts[username], last_commit)
+        self.contributors = OrderedDict(sorted(contributors.items(), key=lambda item: -item[1].contributions))
+        if commits:
+            head = datetime.strptime(commits[-1]['timestamp'], "%Y-%m-%dT%H:%M:%S%z")
+            self.high_water = (push['after'], head.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"))
+        self.last_push = last_push
+        return newest
 
     def load_contributors(self):
         """Loads the contributors for this repository.
@@ -117,49 +263,115 @@ class Repository:
         If `needs_load` is True then it fetches all the
         contributors from the server, and then proceeds to
         load the last_commit for any contributor whose contributions
-        count does not match the cached one.
+        count does not match the cached one. Concurrent loads of the
+        same repository share one fetch.
 
         Raises:
             RepositoryException:
                 Something went wrong loading the repository.
         """
 
+        while self.needs_load:
+            _, shared = flights.do((self.url, "contributors"), self.fetch_contributors,
+                                   bypass=self.fetch_contributors)
+            if not shared:
+                return
+            self.sync()
+        for contrib in self.contributors.values():
+            if contrib.last_commit is None:
+                self.contrib_need_update.add(contrib.username)
+
+    def commits_since_high_water(self):
+        """Returns the newest new commit of each login since the `high_water` mark.
+
+        Only reads commits made after the newest one we have seen, using `since`.
+
+        Returns:
+            The login -> `(email, last_commit)` of each new author and committer, and
+            the new high water mark. `None` if there is no mark, or it wasn't found
+            within `SINCE_MAX_PAGES` pages.
+        """
+        if self.high_water is None:
+            return None
+        sha, date = self.high_water
+        newest = {}
+        high_water = self.high_water
+        for n, commit in enumerate(fetch_all(f"{self.url}/commits", params={'since': date})):
+            if commit['sha'] == sha:
+                return newest, high_water
+            if n >= SINCE_MAX_PAGES * 100:
+                break
+            if n == 0:
+                high_water = (commit['sha'], commit['commit']['committer']['date'])
+            for cmauthor in ("author", "committer"):
+                if commit[cmauthor] and commit[cmauthor]['login'] not in newest:
+                    newest[commit[cmauthor]['login']] = parse_commit(commit, cmauthor)
+        return None
+
+    def fetch_contributors(self):
+        """Fetches the contributors from the server, keeping still valid last commits.
+
+        The last commit of a contributor whose count changed is taken from the
+        commits since the `high_water` mark, if they're in there. Nothing is
+        fetched if another process has stored them while we waited for the flight.
+        """
+        self.sync()
         if not self.needs_load:
-            for contrib in self.contributors.values():
-                if contrib['last_commit'] is None:
-                    self.contrib_need_update.add(contrib['username'])
             return
         try:
+            since = self.commits_since_high_water()
+            newest, high_water = since if since is not None else ({}, None)
             newcontrib = OrderedDict()
-            for contrib in fetch_all(f"{self.url}/contributors"):
-                id = contrib['login']
+            for contrib in fetch_all(f"{self.url}/contributors", parallel=True):
+                id = intern_str(contrib['login'])
                 last_commit = None
                 email = None
                 if (id in self.contributors and
-                    self.contributors[id]['contributions'] == contrib['contributions']):
-                    last_commit = self.contributors[id]['last_commit']
-                    email = self.contributors[id]['email']
+                    self.contributors[id].contributions == contrib['contributions']):
+                    last_commit = self.contributors[id].last_commit
+                    email = self.contributors[id].email
+                elif id in newest:
+                    email, last_commit = newest[id]
 
                 if last_commit is None:
                     self.contrib_need_update.add(id)
 
-                newcontrib[id] = {
-                    "username": contrib['login'],
-                    "email": email,
-                    "image": contrib['avatar_url'],
-                    "contributions": contrib['contributions'],
-                    "last_commit": last_commit
-                }
+                newcontrib[id] = Contributor(id, email, contrib['avatar_url'],
+                                             contrib['contributions'], last_commit)
 
             self.contributors = newcontrib
+            self.high_water = high_water
             self.needs_load = False
             self.store()
+            Repository.cache.save()
 
+        except RequestBudgetExhausted:
+            raise
         except Exception as e:
             raise RepositoryException((f"Failed to load contributors"
                                        f" for repository: {self.name}"))
 
 
+    def load_direct(self, usernames):
+        """Looks up the last commit of each of `usernames` with its own request, on `lookup_pool`.
+
+        Contributors whose lookup the request budget stopped still need updating.
+        """
+        def load(username):
+            self.contrib_need_update.discard(username)
+            try:
+                load_last_commit(self, self.contributors[username])
+            except RequestBudgetExhausted:
+                self.contrib_need_update.add(username)
+
+        for _ in lookup_pool.as_completed(usernames, load):
+            pass
+
+    def needs_commits(self, only:Optional[set]=None):
+        return not ((only and
+            len(self.contrib_need_update.intersection(only)) == 0) or
+            len(self.contrib_need_update) == 0)
+
     def load_last_commits(self, only:Optional[set]=None):
         """Load the last commit for each contributor
         
@@ -167,61 +379,74 @@ class Repository:
         as they come up. If `only` set is passed then break once all contributors
         in only have their last_commits assigned.
 
+        Only one scan per repository runs at a time. Concurrent callers wait for
+        it and only scan themselves if it didn't find what they need, or if it's
+        of lower priority and throttled, in which case they scan their own
+        commit pages.
+
         Args:
             only: Optional; 
                 A set of usernames/logins that we need last_commits for now. If
                 specified this function will break once all are accounted for and
                 any subsequent calls to load_last_commits will continue where the 
-                commit_iter left off.
+                commit_pages left off.
         """
-        if ((only and
-            len(self.contrib_need_update.intersection(only)) == 0) or
-            len(self.contrib_need_update) == 0):
+        while self.needs_commits(only):
+            _, shared = flights.do((self.url, "last_commits"), lambda: self.scan_last_commits(only),
+                                   bypass=lambda: self.scan_last_commits(only, shared=False))
+            if not shared:
+                return
+            self.sync()
+
+    def scan_last_commits(self, only:Optional[set]=None, shared=True):
+        """Resolves the needed last commits the way `planner` finds cheapest.
+
+        Contributors planned for the scan are looked for in the commits. If the
+        scan runs well past the pages it was planned for, the ones still missing
+        are looked up directly instead, if there are at most `DIRECT_MAX_LOOKUPS`.
+        What was found is stored even if the request budget stops the scan, and
+        the next scan starts over.
+
+        Args:
+            only: Optional; The logins whose last commits are needed now.
+            shared: Optional; If false the scan walks commit pages of its own
+                instead of `commit_pages`, so it can run outside the flight.
+        """
+        self.sync()
+        if not self.needs_commits(only):
             return
+        needed = self.contrib_need_update.intersection(only) if only else set(self.contrib_need_update)
+        plan = planner.plan_repository(self, needed)
+        self.load_direct(plan.direct)
+        needed = plan.scan
+        max_count = plan.scan_pages * 100 * SCAN_OVERRUN
         count = 0
-        found = 1
-        for commit in self.commit_iter:
-            count += 1
-            needed = self.contrib_need_update.intersection(only) if only else self.contrib_need_update
-            try:
-                if ((commit['author'] and
-                    commit['author']['login'] in self.contrib_need_update) or (
-                        commit['committer'] and
-                        commit['committer']['login'] in self.contrib_need_update
-                    )):
-
-                    cmauthor = "author" if (commit['author'] and
-                    commit['author']['login'] in self.contrib_need_update) else "committer"
-
-                    author = commit[cmauthor]['login']
-                    commitdate = commit['commit'][cmauthor]['date']
-                    commitdate = datetime.strptime(commitdate,"%Y-%m-%dT%H:%M:%S%z")
-                    commitmessage = commit['commit']['message']
-                    email = commit['commit'][cmauthor]['email']
-
-                    self.contributors[author]['email'] = email
-                    self.contributors[author]['last_commit'] = {
-                        "message": commitmessage,
-                        "date": commitdate
-                    }
-                    self.contrib_need_update.remove(author)
-                    if author in needed:
-                        found += 1
-
-                    if (len(needed) == 0):
-                        break
-                if found / ceil(count / 100) < 0.25 and len(needed) <= 10:
-                    threads = []
-                    for username in needed:
-                        t = Thread(target=load_last_commit, args=(self, self.contributors[username]))
-                        threads.append(t)
-                        t.start()
-                        self.contrib_need_update.remove(username)
-                    for t in threads:
-                        t.join()
+        head = []
+        if not needed:
+            pages = ()
+        elif shared:
+            pages = self.commit_pages
+        else:
+            pages = track_head(fetch_pages(f"{self.url}/commits"), head)
+        try:
+            for page in pages:
+                count += len(page)
+                for author, (commit, cmauthor) in match_commits(page, self.contrib_need_update).items():
+                    contrib = self.contributors[author]
+                    contrib.email, contrib.last_commit = parse_commit(commit, cmauthor)
+                    needed.discard(author)
+                if len(needed) == 0:
                     break
-
-            except Exception as e:
-                print(f"Loading commits failed on commit: {commit}")
-                raise e
-        self.store()
+                if count >= max_count and len(needed) <= DIRECT_MAX_LOOKUPS:
+                    self.load_direct(needed)
+                    break
+        except RequestBudgetExhausted:
+            if shared:
+                with Repository.cachelock:
+                    Repository.commit_iters.pop(self.url, None)
+            raise
+        finally:
+            if self.high_water is None:
+                self.high_water = self.commit_head if shared else (head[0] if head else None)
+            self.store()
+            Repository.cache.save()
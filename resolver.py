@@ -0,0 +1,119 @@
+"""
+This module resolves contributors' last commits in batches through the GraphQL API.
+"""
+from datetime import datetime
+from threading import RLock
+from typing import Dict, Iterable, List, Optional, Tuple
+from github import api
+from records import Commit
+
+MAX_PAIRS = 100
+MAX_QUERY_COST = 10
+
+HISTORY_FIELD = "a{a}: history(first: 1, author: {{id: $u{r}_{a}}}) {{ nodes {{ message author {{ email date }} }} }}"
+REPOSITORY_FIELD = ("r{r}: repository(owner: $o{r}, name: $n{r}) "
+                    "{{ defaultBranchRef {{ target {{ ... on Commit {{ {histories} }} }} }} }}")
+
+
+def chunks(items: List, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class GraphQLCommitResolver:
+    """Finds the latest authored commit of many (repository, author) pairs per query.
+
+    Each pair becomes a `history(first: 1, author: ...)` connection on the
+    repository's default branch, so one query replaces a commit scan or a
+    `/commits?author=` request per pair. Batches are sized from the cost Github
+    reports for previous queries, so a query stays under `max_cost` points and
+    within what is left of the GraphQL budget.
+    """
+
+    def __init__(self, max_pairs=MAX_PAIRS, max_cost=MAX_QUERY_COST):
+        self.max_pairs = max_pairs
+        self.max_cost = max_cost
+        self.cost_per_pair = 1 / 100
+        self.user_ids: Dict[str, Optional[str]] = {}
+        self.lock = RLock()
+
+    def batch_size(self) -> int:
+        """The number of pairs the next query can afford."""
+        with self.lock:
+            cost_per_pair = self.cost_per_pair
+        budget = min(self.max_cost, max(api.scheduler.total_headroom("graphql"), 1))
+        return max(1, min(self.max_pairs, int(budget / cost_per_pair)))
+
+    def record_cost(self, cost, pairs):
+        with self.lock:
+            self.cost_per_pair = (self.cost_per_pair + cost / pairs) / 2
+
+    def load_user_ids(self, logins: Iterable[str]):
+        """Looks up the node ids of `logins`. Logins without a user (e.g. bots) map to None."""
+        with self.lock:
+            missing = sorted(set(login for login in logins if login not in self.user_ids))
+        for batch in chunks(missing, self.max_pairs):
+            params = ", ".join(f"$l{n}: String!" for n in range(len(batch)))
+            fields = " ".join(f"u{n}: user(login: $l{n}) {{ id }}" for n in range(len(batch)))
+            data = api.graphql(f"query({params}) {{ {fields} }}",
+                               {f"l{n}": login for n, login in enumerate(batch)})
+            with self.lock:
+                for n, login in enumerate(batch):
+                    user = data.get(f"u{n}")
+                    self.user_ids[login] = user['id'] if user else None
+
+    def resolve(self, pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Tuple[str, Commit]]:
+        """Finds the last commit of each `(repository url, login)` pair.
+
+        Returns:
+            `(email, last_commit)` keyed by pair, for every pair that has a commit.
+        """
+        pairs = list(pairs)
+        self.load_user_ids(login for _, login in pairs)
+        with self.lock:
+            pairs = [(url, login, self.user_ids[login]) for url, login in pairs if self.user_ids[login]]
+        found = {}
+        start = 0
+        while start < len(pairs):
+            size = self.batch_size()
+            batch = pairs[start:start + size]
+            found.update(self.query_batch(batch))
+            start += size
+        return found
+
+    def query_batch(self, batch: List[Tuple[str, str, str]]) -> Dict[Tuple[str, str], Tuple[str, Commit]]:
+        by_repo: Dict[str, List[Tuple[str, str]]] = {}
+        for url, login, user_id in batch:
+            by_repo.setdefault(url, []).append((login, user_id))
+        repos = list(by_repo.items())
+        params, fields, variables = [], [], {}
+        for r, (url, authors) in enumerate(repos):
+            owner, name = url.split("/")[-2:]
+            params += [f"$o{r}: String!", f"$n{r}: String!"]
+            variables[f"o{r}"] = owner
+            variables[f"n{r}"] = name
+            histories = []
+            for a, (_, user_id) in enumerate(authors):
+                params.append(f"$u{r}_{a}: ID!")
+                variables[f"u{r}_{a}"] = user_id
+                histories.append(HISTORY_FIELD.format(r=r, a=a))
+            fields.append(REPOSITORY_FIELD.format(r=r, histories=" ".join(histories)))
+        data = api.graphql(f"query({', '.join(params)}) {{ {' '.join(fields)} rateLimit {{ cost }} }}", variables)
+        if data.get('rateLimit'):
+            self.record_cost(data['rateLimit']['cost'], len(batch))
+
+        found = {}
+        for r, (url, authors) in enumerate(repos):
+            branch = (data.get(f"r{r}") or {}).get('defaultBranchRef')
+            if not branch:
+                continue
+            for a, (login, _) in enumerate(authors):
+                nodes = (branch['target'].get(f"a{a}") or {}).get('nodes') or []
+                if nodes:
+                    commit = nodes[0]
+                    found[(url, login)] = (commit['author']['email'], Commit(
+                        commit['message'], datetime.strptime(commit['author']['date'], "%Y-%m-%dT%H:%M:%S%z")))
+        return found
+
+
+graphql_resolver = GraphQLCommitResolver()
@@ -0,0 +1,75 @@
+"""
+This module handles pre-serialized, compressed response bodies.
+"""
+import gzip
+from cache import CacheControl, StoredLRUCache
+from datetime import datetime
+from flask import Request, Response
+from hashlib import sha256
+from threading import RLock
+from typing import Dict, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+bodycache = StoredLRUCache(maxsize=256 * 1024 * 1024, getsizeof=lambda body: len(body), path="data/body.cache",
+                           keep_evicted=False, lazy=True)
+bodycache_lock = RLock()
+
+
+class EncodedBody:
+    """A response body serialized once, with its compressed variants.
+
+    Each variant has a strong ETag derived from the content hash, so a client
+    that already has the body gets a 304, and anyone else the stored bytes of
+    the encoding they accept, without serializing or compressing again.
+    Brotli is offered if the `brotli` package is installed.
+    """
+
+    def __init__(self, data: bytes, mimetype: str):
+        self.mimetype = mimetype
+        self.digest = sha256(data).hexdigest()[:32]
+        self.variants: Dict[str, bytes] = {
+            "identity": data,
+            "gzip": gzip.compress(data, mtime=0)
+        }
+        if brotli is not None:
+            self.variants["br"] = brotli.compress(data)
+
+    @classmethod
+    def from_response(cls, resp: Response) -> "EncodedBody":
+        return cls(resp.get_data(), resp.mimetype)
+
+    @staticmethod
+    def load(key: str) -> Optional["EncodedBody"]:
+        with bodycache_lock:
+            return bodycache.get(key)
+
+    def store(self, key: str):
+        with bodycache_lock:
+            try:
+                bodycache[key] = self
+            except ValueError:
+                pass
+
+    def __len__(self):
+        return sum(len(variant) for variant in self.variants.values())
+
+    def etag(self, encoding: str) -> str:
+        return self.digest if encoding == "identity" else f"{self.digest}-{encoding}"
+
+    def response(self, request: Request, last_modified: datetime) -> Response:
+        """Answers `request` with a 304 if it has one of our ETags, else with the best accepted variant."""
+        encoding = request.accept_encodings.best_match(list(self.variants), default="identity")
+        if any(request.if_none_match.contains(self.etag(variant)) for variant in self.variants):
+            resp = Response(status=304)
+        else:
+            resp = Response(self.variants[encoding], mimetype=self.mimetype)
+            if encoding != "identity":
+                resp.headers['Content-Encoding'] = encoding
+        resp.set_etag(self.etag(encoding))
+        resp.headers['Vary'] = "Accept-Encoding"
+        resp.headers['Last-Modified'] = CacheControl.get_modifiedsince(last_modified)
+        return resp
@@ -0,0 +1,203 @@
+"""
+This module handles immutable snapshots of Github Organizations' contributor rankings.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from cache import SqliteStore, StoredLRUCache
+from datetime import datetime, timezone
+from records import Contributor
+from threading import RLock
+from time import time
+from typing import List, Optional, Set, Tuple
+
+SNAPSHOT_TTL = 60 * 60
+
+
+def snapshot_size(value) -> int:
+    """Cache helper method: snapshots count by contributors, latest pointers as one."""
+    return len(value) if isinstance(value, RankingSnapshot) else 1
+
+
+snapshotcache = StoredLRUCache(maxsize=5000000, getsizeof=snapshot_size, path="data/snapshot.cache",
+                               keep_evicted=False, lazy=True)
+snapshotcache_lock = RLock()
+fill_store = SqliteStore("data/snapshot_fills.cache")
+
+
+def encode_cursor(token: str, offset: int) -> str:
+    return urlsafe_b64encode(f"{token}:{offset}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[str, int]]:
+    """Returns the `(snapshot token, offset)` of a cursor, or None if it isn't one of ours."""
+    try:
+        token, offset = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        return token, int(offset)
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class RankingSnapshot:
+    """An org's contributor ranking as of one `version` of it, which never changes once taken.
+
+    Every page is a slice of one snapshot, so a client paging through it with
+    the snapshot token (or the cursors) gets a consistent view while the org's
+    totals move on. Last commits are filled in as pages are resolved.
+
+    The ranking is stored once, when the snapshot is taken. Each filled last
+    commit is stored as its own row of `fill_store`, so storing a page writes
+    just that page's entries, and processes filling different pages of a
+    snapshot don't overwrite each other. Other processes' fills are read back
+    a page at a time, see `unresolved`.
+    """
+
+    def __init__(self, name: str, version: str, last_changed: datetime, contributors: List[Contributor]):
+        self.name = name
+        self.version = version
+        self.last_changed = last_changed
+        self.contributors = contributors
+        self.resolved = bytearray(len(contributors))
+        self.taken_at = time()
+        self.filled: Set[int] = set()
+        self.lock = RLock()
+
+    def __getstate__(self):
+        with self.lock:
+            state = dict(self.__dict__)
+        del state['lock']
+        del state['filled']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.filled = set()
+        self.lock = RLock()
+
+    @property
+    def token(self) -> str:
+        return self.version
+
+    @staticmethod
+    def key(name: str, token: str) -> str:
+        return f"{name}@{token}"
+
+    def page_key(self, offset: int, count: int) -> str:
+        """Identifies the page at `offset` of this very snapshot, e.g. to cache its response body."""
+        return f"{RankingSnapshot.key(self.name, self.token)}.{self.taken_at}&offset={offset}&count={count}"
+
+    def fill_key(self, n: int) -> str:
+        """Identifies the last commit filled in at rank `n` of this very snapshot."""
+        return f"{RankingSnapshot.key(self.name, self.token)}#{self.taken_at}#{n:09d}"
+
+    @classmethod
+    def load(cls, name: str, token: Optional[str] = None) -> Optional["RankingSnapshot"]:
+        """Returns the snapshot `token` of org `name`, or its latest one if it's under `SNAPSHOT_TTL` old."""
+        with snapshotcache_lock:
+            if token is None:
+                latest = snapshotcache.get(name)
+                if latest is None or time() - latest[0] > SNAPSHOT_TTL:
+                    return None
+                token = latest[1]
+            return snapshotcache.get(cls.key(name, token))
+
+    @classmethod
+    def take(cls, org, fresh=False) -> "RankingSnapshot":
+        """Returns the snapshot of `org`'s completely loaded ranking, taking it if there's none yet.
+
+        Args:
+            org: The organization, with its contributors loaded.
+            fresh: If true, replaces an existing snapshot of the same version.
+        """
+        version = org.version
+        with snapshotcache_lock:
+            snapshot = None if fresh else cls.load(org.name, version)
+            if snapshot is None:
+                snapshot = cls(org.name, version, org.last_changed.astimezone(timezone.utc),
+                               [contrib.copy() for contrib in org.contributors[:]])
+                snapshotcache[cls.key(org.name, snapshot.token)] = snapshot
+                cls.discard_fills(org.name)
+            snapshotcache[org.name] = (time(), snapshot.token)
+        return snapshot
+
+    @classmethod
+    def discard_fills(cls, name: str):
+        """Deletes the stored fills of org `name`'s snapshots that are no longer stored themselves."""
+        with snapshotcache_lock:
+            taken = {}
+            for key in fill_store.keys(f"{name}@"):
+                snapshot_key, taken_at, _ = key.rsplit("#", 2)
+                if (snapshot_key, taken_at) not in taken:
+                    snapshot = snapshotcache.get(snapshot_key)
+                    taken[snapshot_key, taken_at] = snapshot is not None and str(snapshot.taken_at) == taken_at
+                if not taken[snapshot_key, taken_at]:
+                    fill_store.delete(key)
+
+    @staticmethod
+    def invalidate(name: str):
+        """Stops serving the latest snapshot of org `name` without a token, e.g. after a push.
+
+        Snapshots stay cached for clients paging through them with their token.
+        """
+        with snapshotcache_lock:
+            if name in snapshotcache:
+                del snapshotcache[name]
+
+    def store(self):
+        """Writes the last commits filled in since the last `store`."""
+        with self.lock:
+            for n in self.filled:
+                fill_store.put(self.fill_key(n), (self.contributors[n].email, self.contributors[n].last_commit))
+            self.filled.clear()
+
+    def __len__(self):
+        return len(self.contributors)
+
+    def cursor(self, offset: int) -> Optional[str]:
+        """The cursor of the page starting at `offset`, if there is one."""
+        if offset < 0 or offset >= len(self):
+            return None
+        return encode_cursor(self.token, offset)
+
+    def page(self, offset: int, count: int) -> List[Contributor]:
+        if offset < 0:
+            return []
+        with self.lock:
+            return self.contributors[offset:offset + count]
+
+    def unresolved(self, offset: int, count: int) -> bool:
+        """Whether the last commits of the page at `offset` have yet to be looked for.
+
+        Reads the page's last commits other processes have stored first.
+        """
+        if offset < 0:
+            return False
+        with self.lock:
+            if all(self.resolved[offset:offset + count]):
+                return False
+            stop = min(offset + count, len(self))
+            for key, (email, last_commit) in fill_store.range(self.fill_key(offset), self.fill_key(stop)):
+                n = int(key.rsplit("#", 1)[1])
+                if not self.resolved[n]:
+                    self.contributors[n].email = email
+                    self.contributors[n].last_commit = last_commit
+                    self.resolved[n] = 1
+            return not all(self.resolved[offset:offset + count])
+
+    def fill(self, offset: int, contributors: List[Contributor], only: Optional[Set[str]] = None):
+        """Records the last commits looked up for the page at `offset`.
+
+        Contributors that already have theirs keep it, so overlapping pages agree.
+
+        Args:
+            offset: The page's offset.
+            contributors: The page's contributors, with their last commits.
+            only: Optional; The logins whose last commits are final, if not all of them are.
+        """
+        with self.lock:
+            for n, contrib in enumerate(contributors, offset):
+                if self.resolved[n] or (only is not None and contrib.username not in only):
+                    continue
+                self.contributors[n].email = contrib.email
+                self.contributors[n].last_commit = contrib.last_commit
+                self.resolved[n] = 1
+                self.filled.add(n)
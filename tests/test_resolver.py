@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Tests `GraphQLCommitResolver` against a local stub of Github's GraphQL endpoint.
+
+    python -m unittest discover tests
+"""
+import json
+import sys
+import unittest
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Thread
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import github
+from github import api
+from resolver import GraphQLCommitResolver
+
+USERS = {"alice": "U_alice", "bob": "U_bob", "dependabot": None}
+REPOSITORIES = {
+    "acme/api": {"U_alice": ("Fix the api", "alice@example.com", "2021-03-01T10:00:00Z"),
+                 "U_bob": ("Add a route", "bob@example.com", "2021-02-01T09:30:00Z")},
+    "acme/web": {"U_alice": ("Restyle", "alice@users.noreply.github.com", "2021-01-15T08:00:00Z")},
+    "acme/docs": {"U_bob": ("Document it", "bob@example.com", "2021-04-01T12:00:00Z")},
+    "acme/empty": None,
+}
+
+
+class StubGraphQL(BaseHTTPRequestHandler):
+    """Answers the user and history queries the resolver sends from `USERS` and `REPOSITORIES`."""
+    queries = []
+    cost = 1
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        variables = body['variables']
+        StubGraphQL.queries.append(body)
+        data = {}
+        for name, value in variables.items():
+            if name.startswith("l"):
+                user_id = USERS.get(value)
+                data[f"u{name[1:]}"] = {'id': user_id} if user_id else None
+            elif name.startswith("o"):
+                r = name[1:]
+                commits = REPOSITORIES.get(f"{value}/{variables[f'n{r}']}")
+                data[f"r{r}"] = {'defaultBranchRef': None if commits is None else {'target': {}}}
+            elif name.startswith("u"):
+                r, a = name[1:].split("_")
+                repository = data.get(f"r{r}")
+                commits = REPOSITORIES.get(f"{variables[f'o{r}']}/{variables[f'n{r}']}")
+                if repository is None or repository['defaultBranchRef'] is None:
+                    continue
+                nodes = []
+                if value in commits:
+                    message, email, date = commits[value]
+                    nodes.append({'message': message, 'author': {'email': email, 'date': date}})
+                repository['defaultBranchRef']['target'][f"a{a}"] = {'nodes': nodes}
+        if "rateLimit" in body['query']:
+            data['rateLimit'] = {'cost': StubGraphQL.cost}
+        payload = json.dumps({'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GraphQLCommitResolverTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubGraphQL)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/graphql"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubGraphQL.queries = []
+        StubGraphQL.cost = 1
+        patcher = mock.patch.object(github, "GRAPHQL_URL", self.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def history_queries(self):
+        return [query for query in StubGraphQL.queries if "history" in query['query']]
+
+    def test_resolves_pairs_across_repositories_in_one_query(self):
+        resolver = GraphQLCommitResolver()
+        found = resolver.resolve([
+            ("https://api.github.com/repos/acme/api", "alice"),
+            ("https://api.github.com/repos/acme/api", "bob"),
+            ("https://api.github.com/repos/acme/web", "alice"),
+        ])
+
+        self.assertEqual(len(StubGraphQL.queries), 2)
+        self.assertEqual(len(self.history_queries()), 1)
+        email, commit = found[("https://api.github.com/repos/acme/api", "alice")]
+        self.assertEqual(email, "alice@example.com")
+        self.assertEqual(commit.message, "Fix the api")
+        self.assertEqual(commit.date, datetime.strptime("2021-03-01T10:00:00Z", "%Y-%m-%dT%H:%M:%S%z"))
+        self.assertEqual(found[("https://api.github.com/repos/acme/web", "alice")][1].message, "Restyle")
+        self.assertEqual(found[("https://api.github.com/repos/acme/api", "bob")][1].message, "Add a route")
+
+    def test_splits_pairs_into_batches(self):
+        resolver = GraphQLCommitResolver(max_pairs=2)
+        pairs = [(f"https://api.github.com/repos/acme/{name}", login)
+                 for name in ("api", "web", "docs") for login in ("alice", "bob")]
+        found = resolver.resolve(pairs)
+
+        queries = self.history_queries()
+        self.assertEqual(len(queries), 3)
+        for query in queries:
+            self.assertLessEqual(query['query'].count("history("), 2)
+        self.assertEqual(set(found), {
+            ("https://api.github.com/repos/acme/api", "alice"),
+            ("https://api.github.com/repos/acme/api", "bob"),
+            ("https://api.github.com/repos/acme/web", "alice"),
+            ("https://api.github.com/repos/acme/docs", "bob"),
+        })
+
+    def test_sizes_batches_from_the_reported_cost(self):
+        resolver = GraphQLCommitResolver(max_pairs=100, max_cost=10)
+        self.assertEqual(resolver.batch_size(), 100)
+        StubGraphQL.cost = 10
+        resolver.resolve([
+            ("https://api.github.com/repos/acme/api", "alice"),
+            ("https://api.github.com/repos/acme/api", "bob"),
+            ("https://api.github.com/repos/acme/web", "alice"),
+            ("https://api.github.com/repos/acme/docs", "bob"),
+        ])
+
+        self.assertEqual(resolver.cost_per_pair, (1 / 100 + 10 / 4) / 2)
+        self.assertEqual(resolver.batch_size(), int(10 / resolver.cost_per_pair))
+
+    def test_skips_logins_without_a_user(self):
+        resolver = GraphQLCommitResolver()
+        found = resolver.resolve([
+            ("https://api.github.com/repos/acme/api", "dependabot"),
+            ("https://api.github.com/repos/acme/api", "alice"),
+        ])
+
+        self.assertIsNone(resolver.user_ids["dependabot"])
+        self.assertEqual(list(found), [("https://api.github.com/repos/acme/api", "alice")])
+        self.assertEqual(self.history_queries()[0]['query'].count("history("), 1)
+
+        resolver.resolve([("https://api.github.com/repos/acme/api", "dependabot")])
+        self.assertEqual(len(StubGraphQL.queries), 2)
+
+    def test_skips_repositories_without_a_default_branch(self):
+        resolver = GraphQLCommitResolver()
+        found = resolver.resolve([
+            ("https://api.github.com/repos/acme/empty", "alice"),
+            ("https://api.github.com/repos/acme/docs", "bob"),
+            ("https://api.github.com/repos/acme/docs", "alice"),
+        ])
+
+        self.assertEqual(list(found), [("https://api.github.com/repos/acme/docs", "bob")])
+
+
+if __name__ == '__main__':
+    unittest.main()
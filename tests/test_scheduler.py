@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Tests `RequestScheduler`'s token rotation and reserves against a local stub of Github's rate limits.
+
+    python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from time import monotonic
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from github import (budget, GithubAPI, GithubRateLimitExceeded, Priority, priority, RequestBudget,
+                    RequestBudgetExhausted, RequestScheduler)
+
+RESET = int((datetime.now() + timedelta(hours=1)).timestamp())
+
+
+class StubRateLimits(BaseHTTPRequestHandler):
+    """Answers every GET with an empty object, counting it against its token's window for its resource."""
+    limits = {}
+    used = Counter()
+    lock = Lock()
+
+    def do_GET(self):
+        token = self.headers.get('Authorization', "").replace("token ", "")
+        resource = "search" if self.path.startswith("/search/") else "core"
+        with StubRateLimits.lock:
+            limit, remaining = StubRateLimits.limits.get((token, resource), (5000, 5000))
+            if remaining > 0:
+                remaining -= 1
+                StubRateLimits.limits[token, resource] = (limit, remaining)
+                StubRateLimits.used[token, resource] += 1
+                status, payload = 200, {}
+            else:
+                status, payload = 403, {'message': "API rate limit exceeded"}
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', str(limit))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', str(RESET))
+        self.send_header('X-RateLimit-Resource', resource)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubRateLimits)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        with mock.patch.dict(os.environ, {"HTTP_CACHE_PATH": str(Path(tmp.name) / "http.cache")}):
+            self.api = GithubAPI()
+        self.addCleanup(self.api.close)
+        StubRateLimits.limits = {}
+        StubRateLimits.used = Counter()
+
+    def limit(self, token, resource, limit, remaining):
+        """Sets a token's window on the stub, and tells the scheduler about it as a response would."""
+        StubRateLimits.limits[token, resource] = (limit, remaining)
+        self.api.scheduler.window(token, resource).update({
+            'X-RateLimit-Limit': str(limit), 'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset': str(RESET)})
+
+    def test_sends_each_request_with_the_token_with_the_most_headroom(self):
+        self.api.set_auth_tokens(["a", "b", "", "c"])
+        for token, remaining in (("a", 100), ("b", 300), ("c", 200)):
+            self.limit(token, "core", 5000, remaining)
+
+        for _ in range(150):
+            self.api.get(f"{self.url}/repos/acme/api")
+
+        self.assertEqual(StubRateLimits.used, Counter({("b", "core"): 125, ("c", "core"): 25}))
+        self.assertEqual([self.api.scheduler.headroom(token, "core") for token in "abc"], [100, 175, 175])
+        self.assertEqual(self.api.req_remaining, 450)
+
+    def test_tracks_each_resource_separately(self):
+        self.api.set_auth_tokens(["a", "b"])
+        self.limit("a", "core", 5000, 0)
+        self.limit("b", "core", 5000, 10)
+        self.limit("a", "search", 30, 30)
+        self.limit("b", "search", 30, 5)
+
+        self.api.get(f"{self.url}/search/commits")
+        self.api.get(f"{self.url}/repos/acme/api")
+
+        self.assertEqual(StubRateLimits.used, Counter({("a", "search"): 1, ("b", "core"): 1}))
+        self.assertEqual(self.api.scheduler.total_headroom("search"), 29 + 5)
+        self.assertEqual(self.api.scheduler.total_headroom("core"), 9)
+
+    def test_keeps_reserves_for_more_urgent_requests(self):
+        self.api.set_auth_token("a")
+        scheduler = self.api.scheduler
+        self.limit("a", "core", 100, 41)
+        self.assertTrue(scheduler.available("core", Priority.REVALIDATE))
+
+        self.api.get(f"{self.url}/repos/acme/api")
+
+        self.assertFalse(scheduler.available("core", Priority.REVALIDATE))
+        self.assertTrue(scheduler.available("core", Priority.BACKGROUND))
+        self.limit("a", "core", 100, 20)
+        self.assertFalse(scheduler.available("core", Priority.BACKGROUND))
+        self.assertTrue(scheduler.available("core", Priority.INTERACTIVE))
+
+    def test_background_requests_wait_out_the_reserve(self):
+        self.api.set_auth_token("a")
+        self.limit("a", "core", 100, 20)
+
+        started = monotonic()
+        with budget(RequestBudget(seconds=0.3)), priority(Priority.BACKGROUND):
+            with self.assertRaises(RequestBudgetExhausted):
+                self.api.get(f"{self.url}/repos/acme/api")
+
+        self.assertLess(monotonic() - started, 2)
+        self.assertEqual(StubRateLimits.used, Counter())
+
+    def test_interactive_requests_fail_at_once_without_headroom(self):
+        self.api.set_auth_tokens(["a", "b"])
+        self.limit("a", "core", 5000, 0)
+        self.limit("b", "core", 5000, 1)
+        self.api.get(f"{self.url}/repos/acme/api")
+
+        started = monotonic()
+        with self.assertRaises(GithubRateLimitExceeded) as raised:
+            self.api.get(f"{self.url}/repos/acme/api")
+
+        self.assertLess(monotonic() - started, 1)
+        self.assertEqual(raised.exception.reset_at, RESET)
+        self.assertEqual(StubRateLimits.used, Counter({("b", "core"): 1}))
+
+    def test_windows_roll_over_once_they_reset(self):
+        scheduler = RequestScheduler(["a"])
+        window = scheduler.window("a", "core")
+        window.update({'X-RateLimit-Limit': "5000", 'X-RateLimit-Remaining': "0",
+                       'X-RateLimit-Reset': str(int((datetime.now() - timedelta(seconds=1)).timestamp()))})
+
+        self.assertEqual(scheduler.headroom("a", "core"), 5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
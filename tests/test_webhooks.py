@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Tests the verification of webhook deliveries and how push payloads are applied to the caches.
+
+    python -m unittest discover tests
+"""
+import hmac
+import sys
+import tempfile
+import unittest
+from collections import OrderedDict
+from datetime import datetime, timezone
+from hashlib import sha256
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import aggregate
+import organization
+import snapshot
+import webhooks
+import workers
+from aggregate import OrgAggregate
+from cache import SqliteStore, StoredLRUCache
+from cachetools import LRUCache
+from records import Contributor
+from repository import Repository
+from webhooks import apply_push, handle_event, verify_signature, WebhookPayloadException
+
+ORG = "acme"
+URL = "https://api.github.com/repos/acme/api"
+LISTED = datetime(2021, 3, 1, 10, 0, tzinfo=timezone.utc)
+
+
+def push(before: str, after: str, pushed_at: datetime, authors, ref="refs/heads/main") -> dict:
+    """A push payload of one commit per login in `authors`, the last one at `pushed_at`."""
+    person = lambda login: {'name': login, 'email': f"{login}@example.com", 'username': login}
+    return {
+        'ref': ref, 'before': before, 'after': after,
+        'forced': False, 'created': False, 'deleted': False,
+        'organization': {'login': ORG},
+        'repository': {'full_name': "acme/api", 'default_branch': "main", 'owner': {'login': ORG},
+                       'pushed_at': int(pushed_at.timestamp())},
+        'commits': [{'message': f"Commit {n}", 'timestamp': pushed_at.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                     'author': person(login), 'committer': person(login)}
+                    for n, login in enumerate(authors)],
+    }
+
+
+class VerifySignatureTest(unittest.TestCase):
+
+    def sign(self, body: bytes, secret: str) -> str:
+        return "sha256=" + hmac.new(secret.encode(), body, sha256).hexdigest()
+
+    def test_accepts_the_hmac_of_the_body(self):
+        self.assertTrue(verify_signature(b'{"zen": "hi"}', self.sign(b'{"zen": "hi"}', "s3cret"), "s3cret"))
+
+    def test_rejects_another_secret_or_body(self):
+        signature = self.sign(b'{"zen": "hi"}', "s3cret")
+        self.assertFalse(verify_signature(b'{"zen": "hi"}', signature, "other"))
+        self.assertFalse(verify_signature(b'{"zen": "bye"}', signature, "s3cret"))
+        self.assertFalse(verify_signature(b'{"zen": "hi"}', "sha256=00", "s3cret"))
+
+    def test_rejects_a_missing_signature_or_secret(self):
+        self.assertFalse(verify_signature(b'{}', None, "s3cret"))
+        self.assertFalse(verify_signature(b'{}', self.sign(b'{}', "s3cret"), None))
+
+
+class ApplyPushTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        patches = [
+            mock.patch.object(Repository, "cache", StoredLRUCache(maxsize=100)),
+            mock.patch.object(organization, "repolistcache", StoredLRUCache(maxsize=100)),
+            mock.patch.object(organization, "commitcache", StoredLRUCache(maxsize=100)),
+            mock.patch.object(snapshot, "snapshotcache", StoredLRUCache(maxsize=100)),
+            mock.patch.object(aggregate, "aggregatecache", LRUCache(maxsize=100)),
+            mock.patch.object(aggregate, "aggregate_store", SqliteStore(Path(tmp.name) / "aggregate.cache")),
+            mock.patch.object(workers, "LOCK_DIR", tmp.name),
+            mock.patch.object(webhooks, "revalidate_repository_list"),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        organization.repolistcache[ORG] = (LISTED, [("api", URL, LISTED)])
+        contributors = OrderedDict((login, Contributor(login, None, f"{login}.png", count))
+                                   for login, count in (("alice", 3), ("bob", 2)))
+        Repository.cache[URL] = (LISTED, contributors, ("sha0", "2021-03-01T10:00:00Z"))
+        self.aggregate = OrgAggregate.load(ORG)
+        self.aggregate.add(Repository("api", URL, LISTED))
+
+    def counts(self):
+        _, contributors, high_water = Repository.cache[URL]
+        return {login: contrib.contributions for login, contrib in contributors.items()}, high_water[0]
+
+    def listed_push(self):
+        return organization.listed_repository(ORG, URL)[2]
+
+    def test_applies_a_push_that_starts_at_the_high_water_mark(self):
+        pushed_at = datetime(2021, 3, 2, tzinfo=timezone.utc)
+
+        self.assertEqual(apply_push(push("sha0", "sha1", pushed_at, ["alice", "alice"])), "applied")
+
+        self.assertEqual(self.counts(), ({"alice": 5, "bob": 2}, "sha1"))
+        self.assertEqual(self.listed_push(), pushed_at)
+        self.assertEqual([(contrib.username, contrib.contributions) for contrib in self.aggregate[:]],
+                         [("alice", 5), ("bob", 2)])
+
+    def test_ignores_a_duplicate_delivery(self):
+        delivery = push("sha0", "sha1", datetime(2021, 3, 2, tzinfo=timezone.utc), ["bob"])
+        self.assertEqual(apply_push(delivery), "applied")
+
+        self.assertEqual(apply_push(delivery), "unchanged")
+
+        self.assertEqual(self.counts(), ({"alice": 3, "bob": 3}, "sha1"))
+
+    def test_reloads_a_push_delivered_before_the_one_it_follows(self):
+        first = push("sha0", "sha1", datetime(2021, 3, 2, tzinfo=timezone.utc), ["alice"])
+        second = push("sha1", "sha2", datetime(2021, 3, 3, tzinfo=timezone.utc), ["bob"])
+
+        self.assertEqual(apply_push(second), "reloading")
+        self.assertEqual(apply_push(first), "unchanged")
+
+        self.assertEqual(self.counts(), ({"alice": 3, "bob": 2}, "sha0"))
+        self.assertEqual(self.listed_push(), datetime(2021, 3, 3, tzinfo=timezone.utc))
+        self.assertTrue(Repository("api", URL, self.listed_push()).needs_load)
+
+    def test_relists_an_unknown_repository(self):
+        delivery = push("sha0", "sha1", datetime(2021, 3, 2, tzinfo=timezone.utc), ["alice"])
+        delivery['repository']['full_name'] = "acme/new"
+
+        self.assertEqual(apply_push(delivery), "relisting")
+        webhooks.revalidate_repository_list.assert_called_once_with(ORG)
+
+    def test_rejects_malformed_payloads(self):
+        valid = lambda: push("sha0", "sha1", datetime(2021, 3, 2, tzinfo=timezone.utc), ["alice"])
+        malformed = [valid() for _ in range(5)]
+        del malformed[0]['repository']
+        malformed[1]['commits'] = "alice"
+        malformed[2]['commits'][0]['timestamp'] = "yesterday"
+        malformed[3]['repository']['pushed_at'] = None
+        del malformed[4]['commits'][0]['author']['email']
+
+        for payload in malformed:
+            with self.assertRaises(WebhookPayloadException):
+                handle_event("push", payload)
+        with self.assertRaises(WebhookPayloadException):
+            handle_event("repository", {'action': "created", 'repository': []})
+        self.assertEqual(self.counts(), ({"alice": 3, "bob": 2}, "sha0"))
+
+
+if __name__ == '__main__':
+    unittest.main()
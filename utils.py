@@ -1,24 +1,51 @@
 """Some Utility Functions"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from contextvars import copy_context
 from json.decoder import JSONDecodeError
+from os import getenv
 from threading import Thread
 from queue import Empty, Queue
-from typing import Any, Callable, Iterable, List
-from github import api
+from typing import Any, Callable, Dict, Iterable, List
+from urllib.parse import parse_qsl, urlencode, urlparse
+from github import api, check_deadline, seconds_left
 
-def format_top_contributer(contrib):
-    """Takes the temp form of contributor and returns the data rep for response"""
-    data = dict(contrib)
-    cmessage = data['last_commit']['message']
-    del data['last_commit']
-    data['commit'] = cmessage
-    return data
+PAGE_FANOUT = int(getenv("PAGE_FANOUT", 8))
+page_pool = ThreadPoolExecutor(max_workers=PAGE_FANOUT, thread_name_prefix="page")
 
-def parse_next_page(resp):
+def format_top_contributer(contrib, pending=False):
+    """Takes the temp form of contributor and returns the data rep for response
+
+    `pending` marks a contributor whose last commit was still being looked up when the request budget ran out.
+    """
+    return {
+        'username': contrib.username,
+        'email': contrib.email,
+        'image': contrib.image,
+        'contributions': contrib.contributions,
+        'commit': contrib.last_commit.message if contrib.last_commit else None,
+        'pending': pending
+    }
+
+def parse_links(resp) -> Dict[str, str]:
+    """Maps each rel of the response's `Link` header to its url."""
+    links = {}
     if "Link" in resp.headers:
         for link in resp.headers['Link'].split(","):
             link_url, link_rel = link.strip().split("; ")
-            if "next" in link_rel:
-                return link_url.strip("<").strip(">")
+            rel = link_rel.split("=")[-1].strip('"')
+            links[rel] = link_url.strip("<").strip(">")
+    return links
+
+def parse_next_page(resp):
+    return parse_links(resp).get('next')
+
+def with_page(url, page):
+    """Returns `url` with its `page` query param set to `page`."""
+    parsed = urlparse(url)
+    query = dict(parse_qsl(parsed.query))
+    query['page'] = str(page)
+    return parsed._replace(query=urlencode(query)).geturl()
 
 def fetch_page(url, page=1, per_page=100, params={}):
     params.update({'per_page': per_page, 'page': page})
@@ -34,12 +61,69 @@ def fetch(url, per_page, params={}):
         data = []
     return data, parse_next_page(resp)
 
-def fetch_all(url, per_page=100, params={}):
+def fetch_json(url):
+    try:
+        return api.get(url).json()
+    except JSONDecodeError:
+        return []
+
+def result(future):
+    """Waits for the future's result, raising `RequestBudgetExhausted` if the context's budget deadline passes first."""
+    while True:
+        try:
+            return future.result(timeout=min(seconds_left(), 1))
+        except TimeoutError:
+            check_deadline()
+
+def fetch_all(url, per_page=100, params={}, parallel=False):
+    """Yields every object of a paginated listing in order.
+
+    Args:
+        url: The listing's url.
+        per_page: Objects per page.
+        params: Extra query params.
+        parallel: Optional;
+            If true and the first page links to the last one, the remaining pages
+            are fetched concurrently, at most `PAGE_FANOUT` at a time.
+    """
+    if not parallel:
+        next_page = url
+        while next_page is not None:
+            page_data, next_page = fetch(next_page, per_page, params=params)
+            for obj in page_data:
+                yield obj
+        return
+
+    params.update({'per_page': per_page})
+    resp = api.get(url, params=params)
+    try:
+        yield from resp.json()
+    except JSONDecodeError:
+        return
+    links = parse_links(resp)
+    if 'last' not in links:
+        if 'next' in links:
+            yield from fetch_all(links['next'], per_page, params=params)
+        return
+    last_page = int(dict(parse_qsl(urlparse(links['last']).query))['page'])
+    pending = deque()
+    try:
+        for page in range(2, last_page + 1):
+            pending.append(page_pool.submit(copy_context().run, fetch_json, with_page(links['last'], page)))
+            if len(pending) >= PAGE_FANOUT:
+                yield from result(pending.popleft())
+        while pending:
+            yield from result(pending.popleft())
+    finally:
+        for future in pending:
+            future.cancel()
+
+def fetch_pages(url, per_page=100, params={}):
+    """Like `fetch_all` but yields each page's list of objects."""
     next_page = url
     while next_page is not None:
         page_data, next_page = fetch(next_page, per_page, params=params)
-        for obj in page_data:
-            yield obj
+        yield page_data
 
 def fetch_all_async(url, q, per_page=100, params={}):
     next_page = url
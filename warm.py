@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Warms the persistent caches for a list of Github Organizations, outside the web process.
+
+Each org's repositories, contributors and last commits are loaded in full,
+the same way the background refresher does, at most `--concurrency` orgs at
+a time. Finished orgs are recorded in a checkpoint file, so an interrupted
+run skips them when started again; the org it was in the middle of resumes
+from whatever its caches had already stored.
+
+    ./warm.py [--file ORGS] [--concurrency N] [--interactive] [--restart] [org ...]
+"""
+import argparse
+import json
+import os
+import sys
+from dotenv import load_dotenv
+from pathlib import Path
+from queue import Empty, Queue
+from threading import RLock, Thread
+from time import monotonic
+from typing import List, Set
+from github import api, Priority
+from refresher import load_fully
+from workers import ProcessLock
+
+
+class Checkpoint:
+    """The orgs a run has finished, kept in a JSON file that outlives the process."""
+
+    def __init__(self, path: str, restart=False):
+        self.path = Path(path)
+        self.lock = RLock()
+        self.done: Set[str] = set()
+        if self.path.exists():
+            if restart:
+                self.path.unlink()
+            else:
+                self.done = set(json.loads(self.path.read_text()))
+
+    def add(self, name: str):
+        with self.lock:
+            self.done.add(name)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp = self.path.with_suffix(".tmp")
+            temp.write_text(json.dumps(sorted(self.done)))
+            os.replace(temp, self.path)
+
+
+def read_orgs(names: List[str], path: str = None) -> List[str]:
+    """The org logins from the command line and from `path`, one per line, in order and without repeats."""
+    if path:
+        with open(path) as f:
+            names = names + [line.split("#")[0].strip() for line in f]
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load Github Organizations into the persistent caches.")
+    parser.add_argument("orgs", nargs="*", help="org logins to warm")
+    parser.add_argument("-f", "--file", help="file of org logins, one per line")
+    parser.add_argument("-c", "--concurrency", type=int, default=2, help="orgs loaded at once (default: 2)")
+    parser.add_argument("--interactive", action="store_true",
+                        help="use the whole rate limit, instead of leaving the reserve to the web process")
+    parser.add_argument("--checkpoint", default="data/warm.checkpoint", help="file of finished orgs")
+    parser.add_argument("--restart", action="store_true", help="forget the orgs a previous run finished")
+    args = parser.parse_args(argv)
+
+    orgs = read_orgs(args.orgs, args.file)
+    if not orgs:
+        parser.error("no orgs given")
+    load_dotenv()
+    api.set_auth_tokens(os.getenv("GITHUB_TOKENS", os.getenv("GITHUB_TOKEN", "")).split(","))
+    level = Priority.INTERACTIVE if args.interactive else Priority.BACKGROUND
+
+    checkpoint = Checkpoint(args.checkpoint, args.restart)
+    pending = [name for name in orgs if name not in checkpoint.done]
+    print(f"Warming {len(pending)} of {len(orgs)} orgs, {len(orgs) - len(pending)} already done")
+
+    queue: Queue = Queue()
+    for name in pending:
+        queue.put(name)
+    lock = RLock()
+    finished = []
+    failed = []
+
+    def report(name: str, message: str):
+        with lock:
+            print(f"[{len(finished) + len(failed)}/{len(pending)}] {name}: {message}", flush=True)
+
+    def work():
+        while True:
+            try:
+                name = queue.get_nowait()
+            except Empty:
+                return
+            with lock:
+                print(f"Loading {name}", flush=True)
+            start, requests = monotonic(), api.counter
+            try:
+                with ProcessLock(("refresh", name)):
+                    snapshot = load_fully(name, level)
+            except Exception as e:
+                with lock:
+                    failed.append(name)
+                report(name, f"failed: {e}")
+                continue
+            checkpoint.add(name)
+            with lock:
+                finished.append(name)
+            report(name, f"{len(snapshot)} contributors in {monotonic() - start:.1f}s, "
+                         f"~{api.counter - requests} requests, {api.req_remaining} left")
+
+    threads = [Thread(target=work, daemon=True) for _ in range(max(1, min(args.concurrency, len(pending))))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        print(f"Interrupted after {len(finished)} orgs; run again to resume")
+        return 130
+
+    print(f"Done: {len(finished)} warmed, {len(failed)} failed" + (f" ({', '.join(failed)})" if failed else ""))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
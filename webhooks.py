@@ -0,0 +1,157 @@
+"""
+This module applies Github webhook deliveries to the cached organizations.
+"""
+import hmac
+from aggregate import OrgAggregate
+from datetime import datetime, timezone
+from hashlib import sha256
+from typing import Any, Optional, Union
+from organization import listed_repository, relist_repository, revalidate_repository_list, update_cached_commit
+from repository import Repository
+from snapshot import RankingSnapshot
+from workers import ProcessLock
+
+RELISTED_ACTIONS = {"created", "deleted", "renamed", "transferred", "publicized", "privatized"}
+
+
+class WebhookPayloadException(Exception):
+    """Raised when a webhook delivery lacks a field we read, or it has the wrong type."""
+    def __init__(self, message):
+        self.message = message
+        super().__init__()
+
+    def __str__(self):
+        return self.message
+
+
+def field(payload: Any, key: str, kind, optional=False) -> Any:
+    """Returns `payload[key]`, checking that it's a `kind`, or missing if `optional`.
+
+    Raises:
+        WebhookPayloadException: It isn't.
+    """
+    value = payload.get(key) if isinstance(payload, dict) else None
+    if value is None and optional:
+        return None
+    if not isinstance(value, kind):
+        raise WebhookPayloadException(f"Invalid payload: '{key}' is missing or malformed")
+    return value
+
+
+def owner_login(payload: dict) -> str:
+    """The login of the org (or user) owning the repository of a delivery."""
+    owner = field(payload, 'organization', dict, optional=True)
+    if owner is None:
+        owner = field(field(payload, 'repository', dict), 'owner', dict)
+    return field(owner, 'login', str)
+
+
+def verify_signature(body: bytes, signature: Optional[str], secret: Optional[str]) -> bool:
+    """Whether `signature`, an `X-Hub-Signature-256` header, is the HMAC of `body` with `secret`."""
+    if not secret or not signature:
+        return False
+    expected = "sha256=" + hmac.new(secret.encode(), body, sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def push_time(pushed_at: Union[int, str]) -> datetime:
+    """Parses a push payload's `pushed_at`, a unix timestamp, or a date string elsewhere.
+
+    Raises:
+        WebhookPayloadException: It's neither.
+    """
+    try:
+        if isinstance(pushed_at, int):
+            return datetime.fromtimestamp(pushed_at, timezone.utc)
+        return datetime.strptime(pushed_at, "%Y-%m-%dT%H:%M:%S%z")
+    except (OverflowError, OSError, TypeError, ValueError):
+        raise WebhookPayloadException(f"Invalid payload: can't read the time {pushed_at!r}")
+
+
+def validate_push(push: dict):
+    """Checks that a `push` payload has every field `apply_push` reads, with the right types.
+
+    Raises:
+        WebhookPayloadException: It doesn't.
+    """
+    repository = field(push, 'repository', dict)
+    field(repository, 'full_name', str)
+    push_time(field(repository, 'pushed_at', (int, str)))
+    field(repository, 'default_branch', str, optional=True)
+    field(repository, 'master_branch', str, optional=True)
+    owner_login(push)
+    for key in ('ref', 'before', 'after'):
+        field(push, key, str)
+    for key in ('forced', 'created', 'deleted'):
+        field(push, key, bool)
+    for commit in field(push, 'commits', list):
+        field(commit, 'message', str)
+        push_time(field(commit, 'timestamp', str))
+        for cmauthor in ("author", "committer"):
+            person = field(commit, cmauthor, dict)
+            field(person, 'email', str)
+            field(person, 'username', str, optional=True)
+
+
+def apply_push(push: dict) -> str:
+    """Brings the cached org up to date with a `push` payload.
+
+    The repository's contributors, its share of the org's totals and the org's
+    cached last commits are updated in place if the push can be applied
+    exactly, otherwise only its listed push moves on, so the next request loads
+    that one repository again. Either way the org's latest snapshot is dropped;
+    snapshots of the older version stay available by token. A repository that
+    isn't in the cached listing yet gets the org's listing revalidated.
+
+    Returns:
+        What was done: applied, reloading, unchanged or relisting.
+
+    Raises:
+        WebhookPayloadException: The payload lacks a field we read, or it has the wrong type.
+    """
+    validate_push(push)
+    repository = push['repository']
+    orgname = owner_login(push)
+    url = f"https://api.github.com/repos/{repository['full_name']}"
+    last_push = push_time(repository['pushed_at'])
+    listed = listed_repository(orgname, url)
+    if listed is None:
+        revalidate_repository_list(orgname)
+        return "relisting"
+    name, _, listed_push = listed
+    if listed_push >= last_push:
+        return "unchanged"
+
+    with ProcessLock((url, "contributors")):
+        repo = Repository(name, url, listed_push)
+        newest = repo.apply_push(push, last_push)
+        if newest is not None:
+            repo.store()
+            Repository.cache.save()
+            aggregate = OrgAggregate.load(orgname, create=False)
+            if aggregate is not None:
+                aggregate.add(repo)
+                aggregate.store()
+            for login, (email, last_commit) in newest.items():
+                update_cached_commit(orgname, login, email, last_commit)
+        relist_repository(orgname, url, last_push)
+    RankingSnapshot.invalidate(orgname)
+    return "applied" if newest is not None else "reloading"
+
+
+def handle_event(event: str, payload: dict) -> str:
+    """Applies a verified webhook delivery of type `event`, returning what was done.
+
+    Raises:
+        WebhookPayloadException: The payload lacks a field we read, or it has the wrong type.
+    """
+    if event == "ping":
+        return "pong"
+    if event == "push":
+        return apply_push(payload)
+    if event == "repository" and payload.get('action') in RELISTED_ACTIONS:
+        orgname = owner_login(payload)
+        revalidate_repository_list(orgname)
+        RankingSnapshot.invalidate(orgname)
+        return "relisting"
+    return "ignored"
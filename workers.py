@@ -0,0 +1,313 @@
+"""
+This module handles running work on a shared, bounded pool of threads.
+"""
+import fcntl
+import hashlib
+import os
+from collections import deque
+from contextvars import copy_context
+from os import getenv
+from pathlib import Path
+from queue import Empty, Queue
+from threading import Condition, Event, Lock, Thread
+from time import sleep
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, Optional, Tuple
+from github import (api, budget_exhausted, check_deadline, deadline_passed, Priority, request_priority,
+                    RequestBudgetExhausted, seconds_left)
+
+LOCK_DIR = getenv("LOCK_DIR", "data/locks")
+FLIGHT_POLL = 0.1
+
+
+def throttled(holder: Optional[Priority], level: Priority) -> bool:
+    """Whether work led at priority `holder` may be held back by the scheduler, while `level` is more urgent."""
+    return holder is not None and level < holder and not api.scheduler.available("core", holder)
+
+
+class Batch:
+    """A group of items submitted together, e.g. the repositories of one request.
+
+    `fn` runs in a copy of the submitter's context, so context variables such
+    as the request priority carry over to the workers.
+    """
+
+    def __init__(self, items: Iterable, fn: Callable):
+        self.items = deque(items)
+        self.fn = fn
+        self.context = copy_context()
+        self.background = request_priority.get() != Priority.INTERACTIVE
+        self.results = Queue()
+
+
+class WorkerPool:
+    """A process-wide pool of a fixed number of worker threads.
+
+    Work is submitted in batches. The workers take one item at a time from
+    each active batch in turn, so a large organization can't starve the
+    requests queued behind it. Interactive batches go first, and background
+    batches never occupy more than `background_share` of the workers, as
+    their requests may be held back by the rate limit scheduler.
+
+    Functions run on the pool must not submit work to it and wait for it,
+    as that can deadlock once every worker is busy.
+    """
+
+    def __init__(self, size: int, background_share=0.5):
+        self.size = size
+        self.background_limit = max(1, int(size * background_share))
+        self.background_busy = 0
+        self.batches = deque()
+        self.cond = Condition()
+        self.threads = []
+
+    def start(self):
+        while len(self.threads) < self.size:
+            t = Thread(target=self.run, daemon=True)
+            self.threads.append(t)
+            t.start()
+
+    def as_completed(self, items: Iterable, fn: Callable) -> Iterator:
+        """Runs `fn` on every item and yields each item once `fn` has returned.
+
+        Raises:
+            Exception: Whatever `fn` raised for an item. Items of the batch that
+                haven't started yet are dropped.
+        """
+        for item, error in self.outcomes(items, fn):
+            if error is not None:
+                raise error
+            yield item
+
+    def outcomes(self, items: Iterable, fn: Callable) -> Iterator[Tuple[Any, Optional[Exception]]]:
+        """Runs `fn` on every item and yields each item with what `fn` raised for it, if anything.
+
+        Once the context's request budget deadline passes, the items that
+        haven't started yet are dropped and yielded with `RequestBudgetExhausted`.
+        """
+        batch = Batch(items, fn)
+        count = len(batch.items)
+        if count == 0:
+            return
+        with self.cond:
+            self.start()
+            self.batches.append(batch)
+            self.cond.notify(count)
+        try:
+            expired = False
+            while count > 0:
+                try:
+                    outcome = batch.results.get(timeout=None if expired else min(seconds_left(), FLIGHT_POLL * 10))
+                except Empty:
+                    if not deadline_passed():
+                        continue
+                    expired = True
+                    with self.cond:
+                        dropped = list(batch.items)
+                        batch.items.clear()
+                        if batch in self.batches:
+                            self.batches.remove(batch)
+                    for item in dropped:
+                        count -= 1
+                        yield item, RequestBudgetExhausted()
+                    continue
+                count -= 1
+                yield outcome
+        finally:
+            with self.cond:
+                batch.items.clear()
+                if batch in self.batches:
+                    self.batches.remove(batch)
+
+    def next_batch(self) -> Optional[Batch]:
+        background = None
+        for batch in self.batches:
+            if not batch.background:
+                return batch
+            if background is None and self.background_busy < self.background_limit:
+                background = batch
+        return background
+
+    def run(self):
+        while True:
+            with self.cond:
+                while (batch := self.next_batch()) is None:
+                    self.cond.wait()
+                self.batches.remove(batch)
+                item = batch.items.popleft()
+                if batch.items:
+                    self.batches.append(batch)
+                if batch.background:
+                    self.background_busy += 1
+            try:
+                batch.context.copy().run(batch.fn, item)
+                batch.results.put((item, None))
+            except Exception as e:
+                batch.results.put((item, e))
+            finally:
+                if batch.background:
+                    with self.cond:
+                        self.background_busy -= 1
+                        self.cond.notify()
+
+
+class ProcessLock:
+    """An exclusive lock on `key` shared by every process and thread on the host.
+
+    Held with `flock` on a file in `LOCK_DIR`, so it's released if its holder dies.
+    The holder can record its priority in the file, see `holder_level`.
+
+    The holder deletes the file before unlocking it, so `LOCK_DIR` only holds
+    the files of locks in use. Anyone who locked a file that has been deleted
+    (or replaced) since they opened it tries again on the current one.
+    """
+
+    def __init__(self, key: Hashable):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        self.path = Path(LOCK_DIR) / f"{name}.lock"
+        self.fd: Optional[int] = None
+
+    def acquire(self, blocking=True, level: Optional[Priority] = None) -> bool:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            if self.current(fd):
+                break
+            os.close(fd)
+        if level is not None:
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(int(level)).encode(), 0)
+        self.fd = fd
+        return True
+
+    def holder_level(self) -> Optional[Priority]:
+        """The priority the current holder acquired the lock at, if it recorded one."""
+        try:
+            return Priority(int(self.path.read_text()))
+        except (OSError, ValueError):
+            return None
+
+    def current(self, fd: int) -> bool:
+        """Whether `fd` is still the file at `path`, not one a former holder deleted."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        opened = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) == (opened.st_dev, opened.st_ino)
+
+    def release(self):
+        os.unlink(self.path)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Flight:
+    """One in-flight call of a `SingleFlight` key."""
+
+    def __init__(self, level: Priority):
+        self.level = level
+        self.done = Event()
+        self.result = None
+        self.error: Optional[Exception] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into one call.
+
+    The first caller of a key runs the function. Anyone calling with the same
+    key while it runs waits for it and gets the same result (or exception).
+    If the call stopped because the first caller's request budget ran out,
+    the waiting callers try again themselves, with their own budgets. A
+    waiting caller gives up with `RequestBudgetExhausted` once its own
+    budget's deadline passes.
+
+    A caller given a `bypass` function never waits on a call of lower
+    priority that the scheduler is holding back: it runs `bypass` instead.
+    This applies to the calls of other processes too, which record their
+    priority in the lock. Calls that use state only one caller at a time may
+    use, like a shared iterator, must give a `bypass` that doesn't touch it,
+    or none.
+
+    If `process_locks` is true the function also runs under the key's
+    `ProcessLock`, so other processes' calls for the key wait for it too. They
+    then run the function themselves, so it should start by checking the
+    shared caches for the work it was about to do, and flush what it stores
+    before returning.
+    """
+
+    def __init__(self, process_locks=False):
+        self.lock = Lock()
+        self.flights: Dict[Hashable, Flight] = {}
+        self.process_locks = process_locks
+
+    def do(self, key: Hashable, fn: Callable[[], Any],
+           bypass: Optional[Callable[[], Any]] = None) -> Tuple[Any, bool]:
+        """Runs `fn` unless a call for `key` is already in flight.
+
+        Returns:
+            The result and whether it came from another caller's call.
+        """
+        level = request_priority.get()
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight(level)
+        if not leader:
+            while not flight.done.wait(min(FLIGHT_POLL, seconds_left())):
+                check_deadline()
+                if bypass is not None and throttled(flight.level, level):
+                    return bypass(), False
+            if isinstance(flight.error, RequestBudgetExhausted) and not budget_exhausted():
+                return self.do(key, fn, bypass)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+        try:
+            flight.result = self.lead(key, fn, level, bypass is not None)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+        return flight.result, False
+
+    def lead(self, key: Hashable, fn: Callable[[], Any], level: Priority, bypassable: bool) -> Any:
+        """Runs `fn` under the key's `ProcessLock`, if `process_locks` is set.
+
+        If `bypassable`, `fn` runs without the lock rather than wait on a
+        throttled holder. As the leader is the only caller in this process,
+        its state isn't shared with the holder's.
+        """
+        if not self.process_locks:
+            return fn()
+        lock = ProcessLock(key)
+        while not lock.acquire(blocking=False, level=level):
+            if bypassable and throttled(lock.holder_level(), level):
+                return fn()
+            check_deadline()
+            sleep(min(FLIGHT_POLL, seconds_left()))
+        try:
+            return fn()
+        finally:
+            lock.release()
+
+
+loader_pool = WorkerPool(int(getenv("LOADER_THREADS", 32)))
+lookup_pool = WorkerPool(int(getenv("LOOKUP_THREADS", 8)))
+flights = SingleFlight(process_locks=True)